@@ -0,0 +1,96 @@
+# CBOR for the server's board API - requests are encoded straight into one buffer,
+# without ujson's intermediate strings. Only what the board sends and is answered:
+# maps, arrays, strings, integers, booleans and None.
+mimetype = "application/cbor"
+
+def head(major, length, out):
+    if length < 24:
+        out.append(major << 5 | length)
+    elif length < 0x100:
+        out.append(major << 5 | 24)
+        out.append(length)
+    elif length < 0x10000:
+        out.append(major << 5 | 25)
+        out.extend(length.to_bytes(2, 'big'))
+    else:
+        out.append(major << 5 | 26)
+        out.extend(length.to_bytes(4, 'big'))
+
+def encode(value, out):
+    if value is None:
+        out.append(0xf6)
+    elif value is True:
+        out.append(0xf5)
+    elif value is False:
+        out.append(0xf4)
+    elif isinstance(value, int):
+        if value >= 0:
+            head(0, value, out)
+        else:
+            head(1, -1 - value, out)
+    elif isinstance(value, str):
+        text = value.encode()
+        head(3, len(text), out)
+        out.extend(text)
+    elif isinstance(value, bytes):
+        head(2, len(value), out)
+        out.extend(value)
+    elif isinstance(value, dict):
+        head(5, len(value), out)
+        for key in value:
+            encode(key, out)
+            encode(value[key], out)
+    elif isinstance(value, (list, tuple)):
+        head(4, len(value), out)
+        for item in value:
+            encode(item, out)
+    else:
+        raise TypeError("Can't encode as CBOR")
+
+def dumps(value):
+    out = bytearray()
+    encode(value, out)
+    return out
+
+def decode(data, position):
+    initial = data[position]
+    major, info = initial >> 5, initial & 0x1f
+    position += 1
+    if major == 7:
+        if info == 20 or info == 21:
+            return info == 21, position
+        if info == 22 or info == 23:
+            return None, position
+        raise ValueError("Unsupported CBOR value")
+    if info < 24:
+        length = info
+    elif info < 28:
+        size = 1 << (info - 24)
+        length = int.from_bytes(data[position:position + size], 'big')
+        position += size
+    else:
+        raise ValueError("Unsupported CBOR length")
+    if major == 0:
+        return length, position
+    if major == 1:
+        return -1 - length, position
+    if major == 2:
+        return bytes(data[position:position + length]), position + length
+    if major == 3:
+        return str(data[position:position + length], 'utf-8'), position + length
+    if major == 4:
+        items = []
+        for _ in range(length):
+            item, position = decode(data, position)
+            items.append(item)
+        return items, position
+    if major == 5:
+        mapping = {}
+        for _ in range(length):
+            key, position = decode(data, position)
+            mapping[key], position = decode(data, position)
+        return mapping, position
+    raise ValueError("Unsupported CBOR value")
+
+def loads(data):
+    return decode(data, 0)[0]
@@ -0,0 +1,59 @@
+# Status pings as single UDP datagrams (see the server's heartbeat.py for the layout) -
+# much cheaper than an HTTP request, and the answer still says when to ping next, and
+# whether an update order is waiting (which is then fetched over HTTP)
+import usocket as socket
+import ustruct as struct
+import hashlib
+from config import firmware, version, firmware_url
+
+TAG_SIZE = 8
+
+def sha256(data):
+    return hashlib.sha256(data).digest()
+
+def hmac_sha256(key, message):
+    if len(key) > 64:
+        key = sha256(key)
+    key = key + bytes(64 - len(key))
+    inner = sha256(bytes(b ^ 0x36 for b in key) + message)
+    return sha256(bytes(b ^ 0x5c for b in key) + inner)
+
+# Counts boots, so heartbeats after a reboot aren't taken for replays
+def next_boot():
+    try:
+        with open('heartbeat.boot', 'r') as f:
+            boot = int(f.read()) + 1
+    except (OSError, ValueError):
+        boot = 1
+    with open('heartbeat.boot', 'w') as f:
+        f.write(str(boot))
+    return boot
+
+class Heartbeat():
+    def __init__(self, board_id, key, port, timeout=2):
+        self.board_id = board_id.encode()
+        if len(self.board_id) > 16:
+            raise ValueError("Board IDs longer than 16 bytes don't fit in a heartbeat")
+        self.key = bytes.fromhex(key)
+        host = firmware_url.split('/')[2].split(':')[0]
+        self.address = socket.getaddrinfo(host, port)[0][-1]
+        self.firmware_id = sha256(f"{firmware}-{version}".encode())[:4]
+        self.counter = next_boot() << 32
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(timeout)
+
+    # (update order pending, seconds until the next ping) - None without a valid answer
+    def send(self, uptime):
+        self.counter += 1
+        body = struct.pack("!4sB16s4sIQ", b"FWHB", 1, self.board_id, self.firmware_id, uptime, self.counter)
+        self.sock.sendto(body + hmac_sha256(self.key, body)[:TAG_SIZE], self.address)
+        try:
+            answer = self.sock.recv(64)
+        except OSError: # timed out
+            return None
+        if len(answer) != 15 + TAG_SIZE or hmac_sha256(self.key, answer[:15])[:TAG_SIZE] != answer[15:]:
+            return None
+        magic, flags, next_poll, counter = struct.unpack("!4sBHQ", answer[:15])
+        if magic != b"FWHA" or counter != self.counter:
+            return None # a late answer to an earlier heartbeat
+        return flags & 1 == 1, next_poll
@@ -7,6 +7,7 @@ import ujson as json
 import secrets
 import config
 import ota
+import heartbeat
 
 led = Pin('LED', Pin.OUT)
 start_time = time.time()
@@ -56,30 +57,70 @@ board_info = {
     "board_id": secrets.board_id,
 }
 
+updating = False
+
+# Downloads and installs the update (rebooting into it) - returns how long to wait
+# if the server is too busy to send it right now
+def start_update(secret):
+    global updating
+    if updating: # the order was both pushed and answered to a ping
+        return None
+    updating = True
+    download_info = board_info.copy()
+    download_info["secret"] = secret
+    print("Starting update...")
+    try:
+        ota.install_firmware(**download_info)
+    except ota.RetryLater as e:
+        print(e)
+        return e.seconds
+    except ota.DanglingOrderException:
+        print("Update already installed. Re-sending delete request.")
+    except Exception as e:
+        print(f"Error occured during update: {e}. Trying again.")
+    finally:
+        updating = False
+    return None
+
+# Heartbeats (UDP) if the board has a heartbeat key - HTTP with an update order waiting,
+# or if the heartbeat goes unanswered (the server may not listen for them)
+beat = None
+if getattr(secrets, "heartbeat_key", None) and config.heartbeat_port:
+    try:
+        beat = heartbeat.Heartbeat(secrets.board_id, secrets.heartbeat_key, config.heartbeat_port)
+    except Exception as e:
+        print(f"Heartbeats unavailable: {e}")
+
+# Sends the status over HTTP, starts the update if one is ordered - returns when to ping next
+def http_ping(uptime):
+    to_send = board_info.copy()
+    to_send["uptime"] = uptime
+    response = ota.answer(ota.send(requests.post, f"{config.firmware_url}/status", to_send))
+    print(response)
+    next_poll = response.get("next_poll", config.polling_rate)
+
+    # on update: {"update"=True, "secret"="<some secret>"}
+    if "update" in response and response["update"] == True: # asserting true to avoid just truthy
+        retry_after = start_update(response["secret"])
+        if retry_after:
+            next_poll = retry_after
+    return next_poll
+
 def ping_server(timer):
+    # The server says when to ping next - soon with an update order, rarely when it's busy
+    next_poll = config.polling_rate
     try:
-        to_send = board_info.copy()
-        to_send["uptime"] = time.time() - start_time
-        response = requests.post(
-            f"{config.firmware_url}/status",
-            json = to_send
-        ).json()
-        print(response)
-
-        # on update: {"update"=True, "secret"="<some secret>"}
-        if "update" in response and response["update"] == True: # asserting true to avoid just truthy
-            download_info = board_info.copy()
-            download_info["secret"] = response["secret"]
-            print("Starting update...")
-            ota.install_firmware(**download_info) # for now let it crash to show error
-            try:
-                ota.install_firmware(**download_info)
-            except ota.DanglingOrderException:
-                print("Update already installed. Re-sending delete request.")
-            except:
-                print("Error occured during update. Trying again.")
-    except OSError as e:
+        uptime = time.time() - start_time
+        answer = beat.send(uptime) if beat else None
+        if answer and not answer[0]:
+            next_poll = answer[1]
+        else:
+            next_poll = http_ping(uptime)
+    except (OSError, ValueError) as e: # ValueError: an answer that didn't parse
         print(f"Ping failed: {e}")
+    finally:
+        # re-armed whatever happened, or the board would stop pinging
+        init_ping_server(timer, next_poll)
 
     # Visually show ping
     led.toggle()
@@ -88,7 +129,19 @@ def ping_server(timer):
     time.sleep(0.05)
     led.toggle()
 
-def init_ping_server(timer):
-    timer.init(freq=1/config.polling_rate, mode=Timer.PERIODIC, callback=ping_server)
-    
+# One ping at a time, each arming the timer for the next
+def init_ping_server(timer, seconds=config.polling_rate):
+    timer.init(period=int(seconds * 1000), mode=Timer.ONE_SHOT, callback=ping_server)
+
 init_ping_server(server_timer)
+
+# Update orders are pushed as soon as they are placed (if the server has the push channel),
+# the pings keep going - for liveness, and in case the channel is down
+while config.push_updates:
+    try:
+        ota.listen_for_updates(secrets.board_id, start_update)
+        print("Push channel closed, reconnecting")
+        time.sleep(1)
+    except Exception as e:
+        print(f"Push channel failed: {e}")
+        time.sleep(config.push_retry)
@@ -5,16 +5,103 @@ import uos
 import json
 import ubinascii
 import machine
+import usocket as socket
+import uerrno as errno
+import utime as time
 # Force use of installed 'hashlib' - has some TypeErrors
 #import sys
 #sys.modules['uhashlib'] = sys
 import hashlib
-from config import firmware_url
+try:
+    import deflate # MicroPython 1.21+, for compressed bundles
+except ImportError:
+    deflate = None
+import cbor
+from config import firmware_url, cbor_requests
 
-def DanglingOrderException(Exception):
-    def __init__(to_send):
+# Board API request - CBOR (see cbor.py) if the server is asked to speak it, else JSON
+# The answer's header names are lowercased: requests keeps them as the server sent them,
+# and the ASGI app (like HTTP/2 proxies) sends them in lowercase, the Flask app doesn't
+def send(method, url, to_send, headers=None, **kwargs):
+    headers = headers or {}
+    if cbor_requests:
+        headers["Content-Type"] = cbor.mimetype
+        headers["Accept"] = cbor.mimetype
+        response = method(url, data=cbor.dumps(to_send), headers=headers, **kwargs)
+    else:
+        response = method(url, json=to_send, headers=headers, **kwargs)
+    response.headers = {key.lower(): value for key, value in (response.headers or {}).items()}
+    return response
+
+# The server's answer to send(), whichever way it's encoded
+def answer(response):
+    if response.headers.get("content-type", "").split(';')[0].strip() == cbor.mimetype:
+        return cbor.loads(response.content)
+    return response.json()
+
+class DanglingOrderException(Exception):
+    def __init__(self, to_send):
+        super().__init__("Update already installed")
         update_path = f"{firmware_url}/update/{to_send["board_id"]}"
-        requests.delete(update_path, json=to_send)
+        send(requests.delete, update_path, to_send)
+
+# The server is too busy to send the update right now
+class RetryLater(Exception):
+    def __init__(self, seconds):
+        super().__init__(f"Server busy, retry in {seconds} s")
+        self.seconds = seconds
+
+# The server's push channel (GET /firmware/push/<board_id>, server-sent events) calls
+# on_update(secret) as soon as an update is ordered for this board, instead of it waiting
+# for the next status ping. Returns once the connection drops, or has been quiet for longer
+# than the server's keepalive, so the caller can reconnect.
+# Reads with a short timeout, so timer callbacks (the status pings) still run in between.
+def listen_for_updates(board_id, on_update, quiet_limit=90):
+    _, _, host, path = f"{firmware_url}/push/{board_id}".split('/', 3)
+    hostname, port = (host.split(':') + ['80'])[:2]
+    sock = socket.socket()
+    try:
+        sock.connect(socket.getaddrinfo(hostname, int(port))[0][-1])
+        # HTTP/1.0, so the events aren't chunk encoded
+        sock.write(f"GET /{path} HTTP/1.0\r\nHost: {host}\r\nAccept: text/event-stream\r\n\r\n".encode())
+        sock.settimeout(1)
+        buffer = b""
+        headers_done = False
+        event = None
+        last_heard = time.time()
+        while time.time() - last_heard < quiet_limit:
+            try:
+                data = sock.recv(256)
+            except OSError as e:
+                if e.args[0] == errno.ETIMEDOUT:
+                    continue
+                raise
+            if not data:
+                return # closed by the server
+            last_heard = time.time()
+            buffer += data
+            if not headers_done:
+                if b"\r\n\r\n" not in buffer:
+                    continue
+                head, buffer = buffer.split(b"\r\n\r\n", 1)
+                status = head.split(b" ", 2)[1]
+                if status != b"200":
+                    raise Exception(f"Push channel refused: {status.decode()}")
+                headers_done = True
+                print("Push channel connected")
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.strip().decode()
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event == "update":
+                    message = json.loads(line[5:])
+                    if message.get("update") == True:
+                        on_update(message["secret"])
+                elif not line: # end of the event
+                    event = None
+    finally:
+        sock.close()
 
 def calculate_shasum(path):
     sha = hashlib.sha256()
@@ -23,7 +110,7 @@ def calculate_shasum(path):
             block = f.read(4096)
             if not block:
                 break
-            #print(f"Block (len {len(block)}): {block}")
+            sha.update(block)
     return ubinascii.hexlify(sha.digest()).decode()
     #return sha.hexdigest() # allegedly hexdigest works, but errors 
 
@@ -36,7 +123,35 @@ def rmdir(path):
             uos.remove(entry_path)
     uos.rmdir(path)
 
-# Downloads and extracts the firmware
+def file_size(path):
+    try:
+        return uos.stat(path)[6]
+    except OSError:
+        return 0
+
+def clear_partial_download():
+    for path in ['firmware.download', 'firmware.etag', 'firmware.tar']:
+        try:
+            uos.remove(path)
+        except OSError:
+            pass # fails if it doesn't exist - that's fine
+
+# Decompresses a zlib stream file to file, without holding either in RAM
+def inflate(path, out_path):
+    with open(path, 'rb') as f:
+        decompressor = deflate.DeflateIO(f, deflate.ZLIB)
+        with open(out_path, 'wb') as of:
+            while True:
+                block = decompressor.read(1024)
+                if not block:
+                    break
+                of.write(block)
+
+# Downloads and extracts the firmware, returns the delta info for delta bundles (else None)
+# The server sends a delta bundle (only the changed files) if it knows the installed version
+# An interrupted download is resumed on the next attempt: firmware.download is kept,
+# and only the missing bytes are requested, as long as the bundle (ETag) is the same
+# Bundles are requested deflate-compressed if possible, and decompressed in small blocks
 def download_firmware(firmware, version, board_id, secret):
     download_path = f"{firmware_url}/update/{board_id}"
     print(f"Requesting download from {download_path}...")
@@ -45,18 +160,72 @@ def download_firmware(firmware, version, board_id, secret):
         "version": version,
         "board_id": board_id,
         "secret": secret,
+        "delta": True,
     }
-    response = requests.get(download_path, json=to_send)
+    headers = {}
+    if deflate:
+        headers["Accept-Encoding"] = "deflate"
+    downloaded = file_size('firmware.download')
+    try:
+        with open('firmware.etag', 'r') as f:
+            etag = f.read()
+    except OSError:
+        etag = None
+    if downloaded and etag:
+        print(f"Resuming download from byte {downloaded}")
+        headers["Range"] = f"bytes={downloaded}-"
+        headers["If-Range"] = etag
+
+    response = send(requests.get, download_path, to_send, headers=headers, stream=True)
     if response.status_code == 304: # Indicates dangling update order
+        response.close()
         raise DanglingOrderException(to_send)
-    if response.status_code != 200:
+    if response.status_code == 503: # Too many boards downloading - come back when told to
+        retry_after = int(response.headers.get("retry-after", 60))
+        response.close()
+        raise RetryLater(retry_after)
+    if response.status_code == 416: # Partial file is no good - start over next time
+        response.close()
+        clear_partial_download()
+        raise Exception("Partial download rejected by the server")
+    if response.status_code not in [200, 206]:
+        response.close()
         raise Exception(f"Server responded with: {response.status_code}")
 
-    # Clear previous attempts
+    # 206 - the server still has the same bundle, append the rest
+    # 200 - new or changed bundle (or no partial download), start from zero
+    if response.status_code == 200:
+        downloaded = 0
+        total = int(response.headers.get("content-length", -1))
+    else:
+        total = int(response.headers["content-range"].split('/')[-1])
+    etag = response.headers.get("etag")
+    if etag:
+        with open('firmware.etag', 'w') as f:
+            f.write(etag)
+
+    encoding = response.headers.get("content-encoding")
+
+    with open('firmware.download', 'ab' if downloaded else 'wb') as f:
+        while True:
+            block = response.raw.read(1024)
+            if not block:
+                break
+            f.write(block)
+            downloaded += len(block)
+    response.close()
+    if total >= 0 and downloaded != total:
+        raise Exception(f"Download interrupted at {downloaded}/{total} bytes")
+
     try:
         uos.remove('firmware.tar')
-    except:
-        pass # fails if it doesn't exist - that's fine
+    except OSError:
+        pass
+    if encoding == "deflate":
+        inflate('firmware.download', 'firmware.tar')
+        uos.remove('firmware.download')
+    else:
+        uos.rename('firmware.download', 'firmware.tar')
 
     # remove -rf the firmware directory
     try:
@@ -64,12 +233,10 @@ def download_firmware(firmware, version, board_id, secret):
     except:
         pass # fails if it doesn't exist - that's fine
 
-    with open('firmware.tar', 'wb') as f:
-        f.write(response.content)
-
     # Extract the archive
     uos.mkdir('firmware')
     sha_sums = {}
+    delta = None
     data = tarfile.TarFile('firmware.tar')
     while True:
         i = data.next()
@@ -81,6 +248,8 @@ def download_firmware(firmware, version, board_id, secret):
             file = data.extractfile(i)
             if i.name == "manifest.json":
                 sha_sums = json.loads(file.read())
+            if i.name == "delta.json":
+                delta = json.loads(file.read())
             # Ignore the header file
             if i.name == "@PaxHeader":
                 continue
@@ -89,28 +258,36 @@ def download_firmware(firmware, version, board_id, secret):
             with open(f"/firmware/{i.name}", "wb") as of:
                 of.write(file.read())
 
-    # Check shasums
+    # Check shasums - a bad resumed download has to be fetched again from scratch
     for filename, expected_sha in sha_sums.items():
-        calculated_sha = calculate_shasum(filename)
+        calculated_sha = calculate_shasum(f"firmware/{filename}")
         if calculated_sha != expected_sha:
             print(f"SHA cheksum does not match for {filename}")
-            #print(f"Expected: {expected_sha}")
-            #print(f"Calculated: {calculated_sha}")
-            print("Ignoring due to bad sha implementation.")
-            # No exception as the implementations of sha256 are borked
-            #raise Exception(f"SHA cheksum does not match for {filename}")
+            clear_partial_download()
+            raise Exception(f"SHA cheksum does not match for {filename}")
 
-    return None
+    return delta
 
 def install_firmware(firmware, version, board_id, secret):
-    download_firmware(firmware, version, board_id, secret)
+    delta = download_firmware(firmware, version, board_id, secret)
 
     print("Installing...")
-    # remove all (except secrets.py) python files in root dir
-    root_files = uos.listdir('/')
-    for entry in root_files:
-        if entry.split('.')[-1] == "py" and entry != "secrets.py":
-            uos.remove(entry)
+    if delta is None:
+        # remove all (except secrets.py) python files in root dir
+        root_files = uos.listdir('/')
+        for entry in root_files:
+            if entry.split('.')[-1] == "py" and entry != "secrets.py":
+                uos.remove(entry)
+    else:
+        # delta bundle - unchanged files stay, files missing from the new version are removed
+        print(f"Applying delta from {delta['base']}")
+        for entry in delta["delete"]:
+            if entry == "secrets.py":
+                continue
+            try:
+                uos.remove(entry)
+            except OSError:
+                pass
 
     new_firmware_files = uos.listdir('firmware')
     for entry in new_firmware_files:
@@ -119,11 +296,11 @@ def install_firmware(firmware, version, board_id, secret):
             uos.remove(entry)
         except:
             pass
-        if entry not in ["manifest.json", "@PaxHeader"]: # Just making sure
+        if entry not in ["manifest.json", "delta.json", "@PaxHeader"]: # Just making sure
             uos.rename(f"firmware/{entry}", entry)
 
     rmdir("firmware")
-    uos.remove("firmware.tar")
+    clear_partial_download()
 
     to_send = {
         "firmware": firmware,
@@ -134,7 +311,7 @@ def install_firmware(firmware, version, board_id, secret):
     # send successful install status - delete the order
     print("Sending confirmation of installation")
     update_path = f"{firmware_url}/update/{board_id}"
-    requests.delete(update_path, json=to_send)
+    send(requests.delete, update_path, to_send)
 
     # reboot
     print("Rebooting...")
@@ -6,4 +6,19 @@ firmware_url = "http://192.168.1.209:8000/firmware"
 blink_frequency = 1 # in Hertz
 
 # How frequently the server is contacted, in seconds - low for development
+# (only until the server answers with when to ping next)
 polling_rate = 10
+
+# Listen for update orders on the server's push channel, retrying every push_retry
+# seconds if it isn't available - only the ASGI app has it (the Dockerfile runs the
+# Flask app, which doesn't), so turn it on for servers running asgi.py
+push_updates = False
+push_retry = 300
+
+# Board API requests (and status answers) in CBOR instead of JSON - less for the board
+# to build and parse. False for servers that only speak JSON
+cbor_requests = True
+
+# Status pings as UDP heartbeats, if the board has a heartbeat key (secrets.py) -
+# None to always use HTTP
+heartbeat_port = 8001
@@ -10,6 +10,7 @@ usage() {
     echo "  -s, --ssid SSID          Set the WiFi SSID"
     echo "  -p, --password PASSWORD  Set the WiFi password"
     echo "  -b, --board_id ID        Set the board ID"
+    echo "  -k, --heartbeat-key KEY  The server's HEARTBEAT_KEY, for UDP status heartbeats (default: none, HTTP only)"
     echo "  -h, --help               Display this help message"
     exit 1
 }
@@ -25,6 +26,7 @@ while [[ "$#" -gt 0 ]]; do
         -s|--ssid) SSID="$2"; shift ;;
         -p|--password) PASSWORD="$2"; shift ;;
         -b|--board_id) BOARD_ID="$2"; shift ;;
+        -k|--heartbeat-key) HEARTBEAT_KEY="$2"; shift ;;
         -h|--help) usage ;;
         *) echo "Unknown parameter passed: $1"; usage ;;
     esac
@@ -49,6 +51,13 @@ if [ -z "$BOARD_ID" ]; then
     read -p "Enter Board ID: " BOARD_ID
 fi
 
+# The board only gets its own key, derived from the server's: HMAC-SHA256(HEARTBEAT_KEY, board ID)
+if [ -n "$HEARTBEAT_KEY" ]; then
+    BOARD_KEY="\"$(printf '%s' "$BOARD_ID" | openssl dgst -sha256 -hmac "$HEARTBEAT_KEY" | awk '{print $NF}')\""
+else
+    BOARD_KEY="None"
+fi
+
 # Update config.py
 if [ -f config.py ]; then
     sed -i "s|firmware_url = .*|firmware_url = \"$FIRMWARE_URL\"|" config.py
@@ -69,6 +78,7 @@ wifi = {
     "password": "$PASSWORD",
 }
 board_id = "$BOARD_ID"
+heartbeat_key = $BOARD_KEY
 EOL
 
 echo "Configuration updated successfully."
@@ -0,0 +1,52 @@
+#!/bin/bash
+
+usage() {
+    echo "Usage: $0 (--file|-f) <boards.csv or boards.json>\
+		(--gpg-fingerprint|-g) <gpg fingerprint/key id> (--url|-U) <firmware server url>"
+    exit 1
+}
+
+# Parsing:
+while [[ "$#" -gt 0 ]]; do
+    case $1 in
+        --file|-f) FILE="$2";;
+        --gpg-fingerprint|-g) FINGERPRINT="$2";;
+        --url|-U) URL="$2";;
+        *) echo "Bad argument: $1"; usage;;
+    esac
+    shift; shift
+done
+
+# Check args
+if [[ -z "$FILE" || -z "$FINGERPRINT" || -z "$URL" ]]; then
+    echo "Missing required parameters."
+    usage
+fi
+
+# The server knows the list by its name
+case "$FILE" in
+    *.csv) NAME="boards.csv";;
+    *.json) NAME="boards.json";;
+    *) echo "The board list must be a .csv or .json file"; usage;;
+esac
+
+# Sign the board list
+gpg -u "$FINGERPRINT" --output sig.pgp --detach-sig "$FILE"
+if [[ $? -ne 0 ]]; then
+    echo "Something went wrong with gpg!"
+    exit 1
+fi
+
+# Send the board list
+curl -X PUT "$URL/boards" -F "$NAME=@$FILE;filename=$NAME" -F "sig.asc=@sig.pgp"
+
+if [[ $? -ne 0 ]]; then
+    echo "Importing boards failed :["
+    rm sig.pgp
+    exit 1
+fi
+
+echo
+echo "Boards imported successfully"
+
+rm sig.pgp
@@ -0,0 +1,80 @@
+#!/bin/bash
+
+usage() {
+    echo "Usage: $0 (--firmware|-f) <firmware name> (--version|-v) <version x.x.x>\
+		[ (--boards|-b) <id,id,...> || (--tag|-t) <board tag> || (--site|-s) <site> || (--glob|-G) <id pattern> ]\
+		[(--concurrency|-c) <max outstanding orders>] [(--wave-interval|-w) <seconds>]\
+		(--gpg-fingerprint|-g) <gpg fingerprint/key id> (--url|-U) <firmware server url>"
+    exit 1
+}
+
+# Parsing:
+while [[ "$#" -gt 0 ]]; do
+    case $1 in
+        --firmware|-f) FIRMWARE="$2";;
+        --version|-v) VERSION="$2";;
+        --boards|-b) BOARDS="$2";;
+        --tag|-t) TAG="$2";;
+        --site|-s) SITE="$2";;
+        --glob|-G) GLOB="$2";;
+        --concurrency|-c) CONCURRENCY="$2";;
+        --wave-interval|-w) WAVE_INTERVAL="$2";;
+        --gpg-fingerprint|-g) FINGERPRINT="$2";;
+        --url|-U) URL="$2";;
+        *) echo "Bad argument: $1"; usage;;
+    esac
+    shift; shift
+done
+
+# Check args
+if [[ -z "$FIRMWARE" || -z "$VERSION" || -z "$FINGERPRINT" || -z "$URL" ]]; then
+    echo "Missing required parameters."
+    usage
+fi
+
+# Board selector - exactly one
+if [[ -n "$BOARDS" ]]; then
+    SELECTOR="\"boards\": [\"${BOARDS//,/\", \"}\"]"
+elif [[ -n "$TAG" ]]; then
+    SELECTOR="\"tag\": \"$TAG\""
+elif [[ -n "$SITE" ]]; then
+    SELECTOR="\"site\": \"$SITE\""
+elif [[ -n "$GLOB" ]]; then
+    SELECTOR="\"glob\": \"$GLOB\""
+else
+    echo "Select the boards with --boards, --tag, --site or --glob."
+    usage
+fi
+
+# Write the rollout manifest - the signature covers the whole file
+{
+    echo "{"
+    echo "    \"firmware\": \"$FIRMWARE\","
+    echo "    \"version\": \"$VERSION\","
+    [[ -n "$CONCURRENCY" ]] && echo "    \"concurrency\": $CONCURRENCY,"
+    [[ -n "$WAVE_INTERVAL" ]] && echo "    \"wave_interval\": $WAVE_INTERVAL,"
+    echo "    $SELECTOR"
+    echo "}"
+} > rollout.json
+
+# Sign the manifest
+gpg -u "$FINGERPRINT" --output sig.pgp --detach-sig rollout.json
+if [[ $? -ne 0 ]]; then
+    echo "Something went wrong with gpg!"
+    rm rollout.json
+    exit 1
+fi
+
+# Send the rollout
+curl -X POST "$URL/rollout" -F "rollout.json=@rollout.json" -F "sig.asc=@sig.pgp"
+
+if [[ $? -ne 0 ]]; then
+    echo "Ordering rollout failed :["
+    rm rollout.json sig.pgp
+    exit 1
+fi
+
+echo
+echo "Rollout sent successfully - check its progress at $URL/rollout/<id>"
+
+rm rollout.json sig.pgp
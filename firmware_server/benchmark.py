@@ -0,0 +1,59 @@
+import requests
+import os
+import sys
+import threading
+import time
+
+# Status pings per second the server answers, JSON and CBOR - black box, like test.py,
+# against the server running in Docker (or gunicorn/uvicorn started by hand).
+# Run it before and after a change to the status path:
+#   python benchmark.py [seconds per run] [concurrent clients]
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import cbor
+
+base_url = os.environ.get("BENCHMARK_URL", "http://localhost:8000/firmware")
+
+status = {
+    "firmware": "blinker",
+    "version": "0.1.0",
+    "board_id": "example", # registered (KNOWN_IDS), not a test ID - those log every ping
+    "uptime": 100,
+}
+
+encodings = {
+    "json": ({"json": status}, {}),
+    "cbor": ({"data": cbor.dumps(status)}, {"Content-Type": cbor.mimetype, "Accept": cbor.mimetype}),
+}
+
+def client(encoding, deadline, results):
+    body, headers = encodings[encoding]
+    session = requests.Session() # keep-alive, like a board between pings
+    count, errors = 0, 0
+    while time.monotonic() < deadline:
+        response = session.post(f"{base_url}/status", headers=headers, **body)
+        if response.status_code == 200:
+            count += 1
+        else:
+            errors += 1
+    results.append((count, errors))
+
+def run(encoding, seconds, clients):
+    results = []
+    started = time.monotonic()
+    threads = [threading.Thread(target=client, args=(encoding, started + seconds, results)) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    count = sum(count for count, _ in results)
+    errors = sum(errors for _, errors in results)
+    return f"{encoding:<6} {count / elapsed:>9.0f} req/s  {elapsed / max(count, 1) * clients * 1000:>7.2f} ms/req" \
+        + (f"  ({errors} errors)" if errors else "")
+
+seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+clients = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+
+for encoding in encodings:
+    print(run(encoding, seconds, clients))
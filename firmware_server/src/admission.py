@@ -0,0 +1,103 @@
+import asyncio
+import os
+import random
+import time
+from threading import Condition
+
+# Limits how many bundle downloads are served at once. Requests over the limit wait in a
+# bounded queue for a short while; when the queue is full (or the wait runs out) they are
+# turned away with a Retry-After, instead of piling up on the workers.
+class AdmissionController():
+    def __init__(self, limit: int, queue_size: int, queue_timeout: float):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.average_duration = 1.0 # seconds a download takes, moving average
+        self.condition = Condition()
+
+    # Returns a start time to pass to release(), or None if the request has to go away
+    def acquire(self) -> None | float:
+        with self.condition:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    return None
+                self.waiting += 1
+                admitted = self.condition.wait_for(lambda: self.active < self.limit,
+                                                   timeout=self.queue_timeout)
+                self.waiting -= 1
+                if not admitted:
+                    return None
+            self.active += 1
+            return time.monotonic()
+
+    def release(self, started: float):
+        duration = time.monotonic() - started
+        with self.condition:
+            self.active -= 1
+            self.average_duration = 0.9 * self.average_duration + 0.1 * duration
+            self.condition.notify()
+
+    # Seconds until it is worth trying again - roughly how long it takes to serve everyone
+    # ahead, spread out with jitter so rejected boards don't all come back at once
+    def retry_after(self) -> int:
+        with self.condition:
+            backlog = (self.active + self.waiting) / self.limit
+            base = max(1.0, backlog * self.average_duration)
+        return int(base + random.uniform(0, base)) + 1
+
+    # Served at /firmware/downloads (per worker) - client API
+    def stats(self):
+        with self.condition:
+            return { "active": self.active, "waiting": self.waiting, "limit": self.limit, "queue": self.queue_size }
+
+# The same for the ASGI app: requests over the limit wait on the event loop instead of
+# in a thread - waiting in the loop's executor would take the threads the admitted
+# downloads need to read their bundles, and nothing would ever be released
+class AsyncAdmissionController(AdmissionController):
+    def __init__(self, limit: int, queue_size: int, queue_timeout: float):
+        super().__init__(limit, queue_size, queue_timeout)
+        self.available = asyncio.Condition() # bound to the loop on first use
+
+    async def acquire_async(self) -> None | float:
+        async with self.available:
+            if self.active >= self.limit:
+                if self.waiting >= self.queue_size:
+                    return None
+                self.waiting += 1
+                try:
+                    await asyncio.wait_for(self.available.wait_for(lambda: self.active < self.limit),
+                                           self.queue_timeout)
+                except asyncio.TimeoutError:
+                    return None
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            return time.monotonic()
+
+    async def release_async(self, started: float):
+        async with self.available:
+            self.release(started)
+            self.available.notify()
+
+# Under gunicorn every download - admitted or waiting in the queue - holds one of the
+# worker's WEB_THREADS, so the limit and queue are taken from those, and kept below them
+# with at least one thread left for status pings. The ASGI app waits on the event loop,
+# and only needs the thread while a chunk is read.
+def thread_settings(threads: int, queue_timeout: float):
+    limit = int(os.environ.get("DOWNLOAD_CONCURRENCY") or max(1, threads // 2))
+    queue_size = int(os.environ.get("DOWNLOAD_QUEUE") or max(0, threads - 1 - limit))
+    fitting = min(limit, max(1, threads - 1))
+    fitting_queue = max(0, min(queue_size, threads - 1 - fitting))
+    if (fitting, fitting_queue) != (limit, queue_size):
+        limit, queue_size = fitting, fitting_queue
+        print(f"DOWNLOAD_CONCURRENCY and DOWNLOAD_QUEUE don't fit in WEB_THREADS={threads}, "
+              f"using {limit} and {queue_size}")
+    return dict(limit=limit, queue_size=queue_size, queue_timeout=queue_timeout)
+
+queue_timeout = float(os.environ.get("DOWNLOAD_QUEUE_TIMEOUT", 5))
+downloads = AdmissionController(**thread_settings(int(os.environ.get("WEB_THREADS", 8)), queue_timeout))
+async_downloads = AsyncAdmissionController(limit=int(os.environ.get("DOWNLOAD_CONCURRENCY") or 32),
+                                           queue_size=int(os.environ.get("DOWNLOAD_QUEUE") or 64),
+                                           queue_timeout=queue_timeout)
@@ -1,30 +1,18 @@
-import os
-
 from flask import Flask, request, jsonify
-from pydantic import BaseModel, ValidationError
-import pgpy
 
 from upload import handle_upload
+import admission
+import fleet
+import history
+import registry
+import rollout
+import startup
 import update
 import util
-from util import state
 
 app = Flask(__name__)
 
-# Defined in the Dockerfile
-state["firmware_directory"] = os.environ["FIRMWARE_DIRECTORY"]
-# In lieu of a database for this simple example
-key_path = os.path.join(state["firmware_directory"], 'keys', 'public.asc')
-with open(key_path, 'r') as f:
-    key_block = f.read()
-example_key, _ = pgpy.PGPKey.from_blob(key_block)
-state["trusted_firmware_signers"] = {
-    "John Doe": example_key # ignore the fact that the name is included in the pubkey 
-}
-print(state["trusted_firmware_signers"])
-
-state["known_ids"] = os.environ["KNOWN_IDS"].split(':')
-state["known_test_ids"] =  os.environ["KNOWN_TEST_IDS"].split(':')
+startup.start()
 
 # Placeholder for webui
 #@app.route('/firmware')
@@ -33,50 +21,21 @@ state["known_test_ids"] =  os.environ["KNOWN_TEST_IDS"].split(':')
 
 
 # Receiving status reports from Pi's - board API
-class Status(BaseModel):
-    firmware: str
-    version: str
-    board_id: str
-    uptime: int
-
 @app.route('/firmware/status', methods=['POST'])
 def status():
-    status = request.get_json()
-    if status == None:
-        print("Status data was not JSON")
-        return "Request must be JSON", 400
-
     try:
-        status = Status.model_validate(status)
-    except ValidationError as e:
-        print("Status data is invalid")
-        return f"JSON format is invalid: {e}", 400
-
-    if not status.board_id in state["known_ids"] and not status.board_id in state["known_test_ids"]:
-        print(f"Status received from unknown ID: {status.board_id}")
-        return f"Unknown ID: {status.board_id}", 401
-    
-
-    print(status)
-
-    update_ordered = { "update": True, "secret": None }
-
-    # TESTING
-    if status.board_id in state["known_test_ids"]:
-        print("Test ID detected. Remember to deal with test ID's before production deployment")
-    if status.board_id == "-2":
-        print("Test update order sent")
-        update_ordered["secret"] = "test_secret"
-        return jsonify(update_ordered)
-
-    # Check for update order
-    if status.board_id in state["orders"]:
-        update_ordered["secret"] = state["orders"][status.board_id].secret
-        print(f"Update order detected for board '{status.board_id}'")
-        return jsonify(update_ordered)
-
-    return jsonify({})
-
+        return update.board_answer(update.board_status(update.board_data()))
+    except update.Respond as r:
+        return r()
+
+# Statuses of many boards, relayed by a gateway (JSON array or NDJSON) - board API
+@app.route('/firmware/status/batch', methods=['POST'])
+def status_batch():
+    ndjson = request.mimetype in ["application/x-ndjson", "application/ndjson"]
+    try:
+        return jsonify(update.batch_status(update.batch_data(), ndjson))
+    except update.Respond as r:
+        return r()
 
 # Firmware upload - client API
 @app.route('/firmware/upload', methods=['PUT'])
@@ -88,6 +47,66 @@ def upload():
 def order_update(id):
     return update.order(id)
 
+# Group update order (signed rollout.json) - client API
+@app.route('/firmware/rollout', methods=['POST'])
+def order_rollout():
+    return rollout.create()
+
+# Group update order progress - client API
+@app.route('/firmware/rollout/<id>', methods=['GET'])
+def rollout_status(id):
+    return rollout.status(id)
+
+# Bulk board registration (signed boards.csv or boards.json) - client API
+@app.route('/firmware/boards', methods=['PUT'])
+def import_boards():
+    return registry.import_boards()
+
+# Board registration - client API
+@app.route('/firmware/boards/<id>', methods=['GET'])
+def board_info(id):
+    return registry.board_info(id)
+
+# When a board last sent its status - client API
+@app.route('/firmware/history/<id>/last-seen', methods=['GET'])
+def last_seen(id):
+    return history.last_seen(id)
+
+# When a board rebooted (?hours=) - client API
+@app.route('/firmware/history/<id>/reboots', methods=['GET'])
+def reboots(id):
+    return history.reboots(id)
+
+# Boards per firmware version over time (?hours=, ?bucket= seconds) - client API
+@app.route('/firmware/history/versions', methods=['GET'])
+def version_history():
+    return history.versions()
+
+# Boards per firmware version and liveness, cheap enough to poll - client API
+@app.route('/firmware/fleet', methods=['GET'])
+def fleet_aggregates():
+    return fleet.aggregates()
+
+# Boards that missed their polls - client API
+@app.route('/firmware/fleet/offline', methods=['GET'])
+def offline_boards():
+    return fleet.offline()
+
+# Boards going offline and coming back (server-sent events) - client API
+@app.route('/firmware/fleet/events', methods=['GET'])
+def liveness_events():
+    return fleet.liveness_events()
+
+# Signature verification cache hits and misses (this worker) - client API
+@app.route('/firmware/signatures', methods=['GET'])
+def signature_cache():
+    return jsonify(util.verification_stats())
+
+# Downloads in progress and waiting for a slot (this worker) - client API
+@app.route('/firmware/downloads', methods=['GET'])
+def download_admission():
+    return jsonify(admission.downloads.stats())
+
 # Firmware update download request - board API
 @app.route('/firmware/update/<id>', methods=['GET'])
 def download_update(id):
@@ -107,5 +126,6 @@ def get_available_firmware():
         return str(e), 400
     return jsonify(util.available_firmware(req))
 
+# Development server - the Docker image runs gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,280 @@
+import asyncio
+import json
+import os
+
+from werkzeug.http import parse_accept_header, parse_etags, parse_if_range_header, parse_range_header, quote_etag
+
+import bundle
+import cbor
+import push
+import startup
+import update
+from admission import async_downloads as downloads
+from registry import registry
+from util import state
+
+# The board API (status pings, downloads and install confirmations) as an asyncio ASGI app:
+#   uvicorn asgi:app --host 0.0.0.0 --port 8000 --workers 4
+# A board waiting on the server only costs a coroutine instead of a worker thread, so one
+# node keeps up with far more boards polling - or holding a push channel open (push.py).
+# It uses the same order and bundle code as the Flask app (see the board API section of
+# update.py) - the client API (uploads, orders, rollouts) stays on the Flask app, with a
+# proxy routing between the two.
+startup.start()
+
+max_body = 64 * 1024 # board requests are small JSON (or CBOR) documents
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path, method = scope["path"], scope["method"]
+    if path == "/firmware/status":
+        handler = status if method == "POST" else None
+    elif path == "/firmware/status/batch":
+        handler = status_batch if method == "POST" else None
+    elif path.startswith("/firmware/push/"):
+        id = path.removeprefix("/firmware/push/")
+        handler = (lambda scope, receive, send: push_channel(id, scope, receive, send)) if method == "GET" else None
+    elif path.startswith("/firmware/update/"):
+        id = path.removeprefix("/firmware/update/")
+        handler = {
+            "GET": lambda scope, receive, send: download(id, scope, receive, send),
+            "DELETE": lambda scope, receive, send: delete(id, scope, receive, send),
+        }.get(method)
+    else:
+        await respond(send, "Not found", 404)
+        return
+
+    if not handler:
+        await respond(send, "Method not allowed", 405)
+        return
+    try:
+        await handler(scope, receive, send)
+    except update.Respond as r:
+        await respond(send, *r())
+
+# Nothing to set up or tear down per server - startup.start() runs on import,
+# once per worker process
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({ "type": "lifespan.startup.complete" })
+        elif message["type"] == "lifespan.shutdown":
+            await send({ "type": "lifespan.shutdown.complete" })
+            return
+
+def header(scope, name: bytes) -> None | str:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+async def read_body(receive, limit=max_body) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return b""
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if len(body) > limit:
+            raise update.Respond("Request too large", 413)
+    return body
+
+# The request body for the board API: parsed CBOR (see cbor.py, None if it doesn't decode),
+# or the JSON as bytes - validated by the models directly
+async def read_data(scope, receive) -> None | dict | bytes:
+    body = await read_body(receive)
+    content_type = (header(scope, b"content-type") or "").split(';')[0].strip()
+    if content_type != cbor.mimetype:
+        return body
+    try:
+        return cbor.loads(body)
+    except ValueError:
+        return None
+
+async def respond(send, body, status_code, headers={}):
+    if status_code == 304: # not allowed to have a body
+        body = ""
+    if isinstance(body, str):
+        content, content_type = body.encode('utf-8'), "text/plain; charset=utf-8"
+    else:
+        content, content_type = json.dumps(body).encode('utf-8'), "application/json"
+    await send_response(send, content, content_type, status_code, headers)
+
+async def send_response(send, content: bytes, content_type, status_code, headers={}):
+    await send({
+        "type": "http.response.start",
+        "status": status_code,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(content)).encode()),
+                    *((key.lower().encode(), value.encode()) for key, value in headers.items())],
+    })
+    await send({ "type": "http.response.body", "body": content })
+
+# Status pings read the order storage - SQLite, which can wait on a lock for a while, so
+# not on the event loop
+async def status(scope, receive, send):
+    answer = await asyncio.to_thread(update.board_status, await read_data(scope, receive))
+    as_cbor = update.wants_cbor(header(scope, b"accept"))
+    await send_response(send, update.encode_answer(answer, as_cbor), cbor.mimetype if as_cbor else "application/json", 200)
+
+async def status_batch(scope, receive, send):
+    content_type = (header(scope, b"content-type") or "").split(';')[0].strip()
+    ndjson = content_type in ["application/x-ndjson", "application/ndjson"]
+    body = await read_body(receive, update.batch_max_body) # gateways relay many statuses
+    await respond(send, await asyncio.to_thread(update.batch_status, body, ndjson), 200)
+
+# Update orders as server-sent events, the moment they are placed - the order the board
+# already has (if any) comes first. Comments keep the connection from looking dead.
+async def push_channel(id, scope, receive, send):
+    if id not in registry:
+        print(f"Push channel requested by unknown ID: {id}")
+        raise update.Respond(f"Unknown ID: {id}", 401)
+
+    channel = push.channels.open(id)
+    async def hang_up():
+        await watch_disconnect(receive, asyncio.Event())
+        push.channels.send(channel, None)
+    watcher = asyncio.create_task(hang_up())
+    try:
+        await send({ "type": "http.response.start", "status": 200,
+                     "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")] })
+        order = await asyncio.to_thread(state["orders"].get, id)
+        if order:
+            await send_event(send, "update", { "update": True, "secret": order.secret })
+        else:
+            await send({ "type": "http.response.body", "body": b": connected\n\n", "more_body": True })
+        _, queue = channel
+        while True:
+            try:
+                message = await asyncio.wait_for(queue.get(), push.keepalive)
+            except asyncio.TimeoutError:
+                await send({ "type": "http.response.body", "body": b": keepalive\n\n", "more_body": True })
+                continue
+            if message is None:
+                break
+            await send_event(send, "update", message)
+    finally:
+        watcher.cancel()
+        push.channels.close(id, channel)
+
+async def send_event(send, kind, data: dict):
+    await send({ "type": "http.response.body", "body": f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode(),
+                 "more_body": True })
+
+async def delete(id, scope, receive, send):
+    data = await read_data(scope, receive)
+    await respond(send, await asyncio.to_thread(update.complete_request, id, data), 200)
+
+async def download(id, scope, receive, send):
+    data = await read_data(scope, receive)
+    dl_req, order = await asyncio.to_thread(update.check_download, id, data)
+
+    # Too many boards downloading at once - tell this one when to come back
+    started = await downloads.acquire_async()
+    if started is None:
+        retry_after = downloads.retry_after()
+        print(f"Download from '{id}' turned away, retry after {retry_after} s")
+        await respond(send, "Too many downloads in progress", 503, {"Retry-After": str(retry_after)})
+        return
+
+    # The slot is only freed once the whole response has been sent
+    try:
+        range_header = header(scope, b"range")
+        info = await asyncio.to_thread(update.select_bundle, dl_req, order, range_header is not None)
+        disconnected = asyncio.Event()
+        watcher = asyncio.create_task(watch_disconnect(receive, disconnected))
+        try:
+            if bundle.is_built(info):
+                await send_bundle(scope, send, info, range_header, disconnected)
+            else:
+                await stream_bundle(send, info, disconnected)
+        finally:
+            watcher.cancel()
+    finally:
+        await downloads.release_async(started)
+
+async def watch_disconnect(receive, disconnected: asyncio.Event):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+    disconnected.set()
+
+# Same as update.send_bundle: a built bundle (or its compressed variant) from disk,
+# answering Range/If-Range requests so boards can resume
+async def send_bundle(scope, send, info: bundle.BundleInfo, range_header, disconnected):
+    accept_encodings = parse_accept_header(header(scope, b"accept-encoding"))
+    encoding = bundle.negotiate_encoding(info, accept_encodings)
+    path = bundle.variant_path(info, encoding) if encoding else info.path
+    etag = bundle.variant_etag(info, encoding)
+    headers = [(b"content-type", b"application/tar"), (b"etag", quote_etag(etag).encode()),
+               (b"vary", b"Accept-Encoding")]
+    if encoding:
+        headers.append((b"content-encoding", encoding.encode()))
+
+    # the front end answers Range/If-Range requests itself
+    if update.sendfile_mode != "wrapper":
+        if update.sendfile_mode == "x-sendfile":
+            headers.append((b"x-sendfile", path.encode()))
+        else:
+            headers.append((b"x-accel-redirect", f"{update.accel_prefix}/{os.path.basename(path)}".encode()))
+        await send({ "type": "http.response.start", "status": 200, "headers": headers })
+        await send({ "type": "http.response.body", "body": b"" })
+        return
+
+    # the board already has this bundle (like send_file, checked before any Range)
+    if_none_match = header(scope, b"if-none-match")
+    if if_none_match and parse_etags(if_none_match).contains_weak(etag):
+        await send({ "type": "http.response.start", "status": 304, "headers": headers })
+        await send({ "type": "http.response.body", "body": b"" })
+        return
+
+    size = os.path.getsize(path)
+    start, stop, status_code = 0, size, 200
+    # a Range only applies if the board still has the same bundle (If-Range)
+    if_range = header(scope, b"if-range")
+    requested = parse_range_header(range_header) if range_header else None
+    if requested and (not if_range or parse_if_range_header(if_range).etag == etag):
+        span = requested.range_for_length(size)
+        if span is None:
+            await respond(send, "Requested range not satisfiable", 416, {"Content-Range": f"bytes */{size}"})
+            return
+        start, stop = span
+        status_code = 206
+        headers.append((b"content-range", f"bytes {start}-{stop - 1}/{size}".encode()))
+    headers += [(b"content-length", str(stop - start).encode()), (b"accept-ranges", b"bytes")]
+
+    await send({ "type": "http.response.start", "status": status_code, "headers": headers })
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = stop - start
+        while remaining and not disconnected.is_set():
+            block = await asyncio.to_thread(f.read, min(bundle.chunk_size, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            await send({ "type": "http.response.body", "body": block, "more_body": remaining > 0 })
+
+# Same as update.bundle_response for bundles that aren't built yet: generated on the fly
+# (and written to disk) in a worker thread, block by block
+async def stream_bundle(send, info: bundle.BundleInfo, disconnected):
+    headers = [(b"content-type", b"application/tar"), (b"content-length", str(info.size).encode()),
+               (b"accept-ranges", b"bytes"), (b"etag", quote_etag(info.digest).encode()),
+               (b"vary", b"Accept-Encoding")]
+    await send({ "type": "http.response.start", "status": 200, "headers": headers })
+    blocks = bundle.stream_bundle(info)
+    try:
+        while not disconnected.is_set():
+            block = await asyncio.to_thread(next, blocks, None)
+            if block is None:
+                await send({ "type": "http.response.body", "body": b"" })
+                break
+            await send({ "type": "http.response.body", "body": block, "more_body": True })
+    finally:
+        # lets an unfinished build clean up after itself
+        await asyncio.to_thread(blocks.close)
@@ -0,0 +1,258 @@
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from pydantic import BaseModel
+
+import manifests
+from util import state
+
+# Bundles are the tar archives (firmware files + manifest.json) sent to boards.
+# The archive is fully determined by the upload manifest, so its size and content hash
+# are known without building it. It is streamed from the firmware files the first time,
+# and written to the bundle directory on the way so later downloads are served from disk.
+#
+# Delta bundles only contain the files that differ from the version installed on the board,
+# plus a delta.json listing the files to delete.
+memory_cache_size = int(os.environ.get("BUNDLE_CACHE_ENTRIES", 8))
+chunk_size = 64 * 1024
+
+BLOCKSIZE = tarfile.BLOCKSIZE
+
+# Precompressed variants stored next to each bundle: Content-Encoding -> (suffix, zlib wbits)
+# A 4 KiB window keeps decompression on the boards cheap, at a small cost in ratio
+window_bits = 12
+encodings = {
+    "deflate": (".zz", window_bits), # zlib format, as HTTP defines "deflate"
+    "gzip": (".gz", 16 + window_bits),
+}
+# Changes whenever the archive layout changes, so old bundles on disk aren't reused
+archive_format = b"ustar-v2"
+
+class BundleInfo(BaseModel):
+    firmware: str
+    version: str
+    base: Optional[str] = None # installed {firmware}-{version} a delta bundle applies to
+    fingerprint: str # of the firmware directories the bundle was built from
+    digest: str = "" # sha256 of the bundle's metadata - also its filename
+    size: int = 0 # of the whole tar archive
+    files: dict[str, manifests.FileDigest]
+    delete: list[str] = []
+
+    @property
+    def name(self):
+        target = f"{self.firmware}-{self.version}"
+        return f"{self.base}..{target}" if self.base else target
+
+    @property
+    def path(self):
+        return os.path.join(state["bundle_directory"], f"{self.digest}.tar")
+
+    # Generated files at the end of the archive
+    def metadata_entries(self) -> dict[str, bytes]:
+        # manifest.json - the format the boards expect
+        shasums = { name: digest.sha256 for name, digest in self.files.items() }
+        entries = { "manifest.json": json.dumps(shasums).encode('utf-8') }
+        if self.base:
+            delta = { "base": self.base, "delete": self.delete }
+            entries["delta.json"] = json.dumps(delta).encode('utf-8')
+        return entries
+
+    def finalize(self):
+        sha = hashlib.sha256(archive_format)
+        entry_sizes = [digest.size for digest in self.files.values()]
+        for name, contents in self.metadata_entries().items():
+            sha.update(f"{name}:{len(contents)};".encode('utf-8') + contents)
+            entry_sizes.append(len(contents))
+        self.digest = sha.hexdigest()
+        self.size = archive_size(entry_sizes)
+        return self
+
+# name -> BundleInfo, most recently used last
+memory_cache: OrderedDict[str, BundleInfo] = OrderedDict()
+cache_lock = Lock()
+# Digests currently being written to disk, so concurrent first downloads don't all write it
+building: set[str] = set()
+
+def firmware_directory(firmware, version):
+    return os.path.join(state["firmware_directory"], f"{firmware}-{version}")
+
+def padded(size):
+    return -(-size // BLOCKSIZE) * BLOCKSIZE
+
+# Headers are built by hand (ustar, fixed mtime/owner) so the archive only depends on
+# the file contents, and every entry takes exactly one header block
+def tar_header(name, size) -> bytes:
+    info = tarfile.TarInfo(name=name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = 0
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+# Archives end with the two zero blocks only - padding to tarfile's 10 KiB records would
+# just be more bytes over the air
+def archive_size(entry_sizes) -> int:
+    return sum(BLOCKSIZE + padded(entry_size) for entry_size in entry_sizes) + 2 * BLOCKSIZE
+
+# Looks up bundle metadata in the LRU, only calling make() if the fingerprint changed
+def cached_info(name, fingerprint, make) -> BundleInfo:
+    with cache_lock:
+        cached = memory_cache.get(name)
+        if cached and cached.fingerprint == fingerprint:
+            memory_cache.move_to_end(name)
+            return cached
+
+    info = make()
+
+    with cache_lock:
+        memory_cache[name] = info
+        memory_cache.move_to_end(name)
+        while len(memory_cache) > memory_cache_size:
+            memory_cache.popitem(last=False)
+
+    # The previous bundle of a changed firmware directory will never be served again
+    if cached and cached.digest != info.digest:
+        remove_bundle(cached)
+    return info
+
+# Returns the bundle for a firmware version (known to exist)
+def get_bundle(firmware, version) -> BundleInfo:
+    firmware_dir = firmware_directory(firmware, version)
+    fingerprint = manifests.directory_fingerprint(firmware_dir)
+
+    def make():
+        manifest = manifests.get_manifest(firmware, version, firmware_dir, fingerprint)
+        return BundleInfo(firmware=firmware, version=version, fingerprint=fingerprint,
+                          files=manifest.files).finalize()
+
+    return cached_info(f"{firmware}-{version}", fingerprint, make)
+
+# Returns the delta bundle from the installed version to the target version,
+# or None if the installed version isn't known to the server
+def get_delta(base_firmware, base_version, firmware, version) -> None | BundleInfo:
+    # the installed version is reported by the board - don't let it point outside the directory
+    base_name = f"{base_firmware}-{base_version}"
+    if os.path.basename(base_name) != base_name or base_name.startswith('.') or base_name == "keys":
+        return None
+    if not os.path.isdir(firmware_directory(base_firmware, base_version)):
+        return None
+    base = get_bundle(base_firmware, base_version)
+    target = get_bundle(firmware, version)
+    fingerprint = hashlib.sha256(f"{base.fingerprint}{target.fingerprint}".encode('utf-8')).hexdigest()
+
+    def make():
+        changed = { name: digest for name, digest in target.files.items()
+                    if name not in base.files or base.files[name].sha256 != digest.sha256 }
+        deleted = sorted(base.files.keys() - target.files.keys())
+        print(f"Delta '{base.name}..{target.name}': {len(changed)} changed, {len(deleted)} deleted")
+        return BundleInfo(firmware=firmware, version=version, base=base.name,
+                          fingerprint=fingerprint, files=changed, delete=deleted).finalize()
+
+    return cached_info(f"{base.name}..{target.name}", fingerprint, make)
+
+def is_built(info: BundleInfo):
+    return os.path.isfile(info.path)
+
+def variant_path(info: BundleInfo, encoding):
+    return info.path + encodings[encoding][0]
+
+def variant_etag(info: BundleInfo, encoding):
+    return f"{info.digest}-{encoding}" if encoding else info.digest
+
+# Best Content-Encoding out of the ones the board accepts that has been built, None for identity
+def negotiate_encoding(info: BundleInfo, accept_encodings) -> None | str:
+    encoding = accept_encodings.best_match(list(encodings))
+    if encoding and os.path.isfile(variant_path(info, encoding)):
+        return encoding
+    return None
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def remove_bundle(info: BundleInfo):
+    remove_file(info.path)
+    for encoding in encodings:
+        remove_file(variant_path(info, encoding))
+
+# Generates the archive block by block - memory use doesn't depend on the bundle size
+def generate_archive(info: BundleInfo):
+    firmware_dir = firmware_directory(info.firmware, info.version)
+    written = 0
+    for name, digest in info.files.items():
+        yield tar_header(name, digest.size)
+        with open(os.path.join(firmware_dir, name), 'rb') as f:
+            for block in iter(lambda: f.read(chunk_size), b''):
+                yield block
+        yield bytes(padded(digest.size) - digest.size)
+        written += BLOCKSIZE + padded(digest.size)
+
+    # include shasums in archive (can't really send separately unless I want to do multipart)
+    for name, contents in info.metadata_entries().items():
+        yield tar_header(name, len(contents))
+        yield contents + bytes(padded(len(contents)) - len(contents))
+        written += BLOCKSIZE + padded(len(contents))
+
+    yield bytes(info.size - written) # end of archive marker
+
+# Writes the archive into the bundle directory, passing the blocks on to the caller.
+# The file only appears there once it is complete.
+def write_bundle(info: BundleInfo):
+    fd, tmp_path = tempfile.mkstemp(dir=state["bundle_directory"], suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for block in generate_archive(info):
+                f.write(block)
+                yield block
+        if os.path.getsize(tmp_path) != info.size:
+            raise Exception(f"Bundle '{info.name}' does not match its manifest")
+        os.replace(tmp_path, info.path)
+        print(f"Built bundle '{info.name}' ({info.size} bytes, {info.digest})")
+    finally:
+        # Only left behind on errors or a client disconnecting mid-download
+        remove_file(tmp_path)
+    compress_bundle(info)
+
+# Writes the compressed variants of a built bundle, once
+def compress_bundle(info: BundleInfo):
+    for encoding, (suffix, wbits) in encodings.items():
+        fd, tmp_path = tempfile.mkstemp(dir=state["bundle_directory"], suffix=".tmp")
+        try:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, wbits)
+            with open(info.path, 'rb') as f, os.fdopen(fd, 'wb') as out:
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    out.write(compressor.compress(block))
+                out.write(compressor.flush())
+            os.replace(tmp_path, info.path + suffix)
+        finally:
+            remove_file(tmp_path)
+    print(f"Compressed bundle '{info.name}' ({', '.join(encodings)})")
+
+# Streams the archive, writing it to disk at the same time
+def stream_bundle(info: BundleInfo):
+    with cache_lock:
+        already_building = info.digest in building
+        building.add(info.digest)
+    if already_building:
+        # someone else is already writing this bundle - just stream it
+        yield from generate_archive(info)
+        return
+
+    try:
+        yield from write_bundle(info)
+    finally:
+        with cache_lock:
+            building.discard(info.digest)
+
+# Builds the archive on disk without sending it anywhere
+def build_bundle(info: BundleInfo):
+    for _block in write_bundle(info):
+        pass
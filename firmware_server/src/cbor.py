@@ -0,0 +1,148 @@
+import struct
+
+# CBOR (RFC 8949) for the board API: boards can send their requests (and get their status
+# answers) as CBOR instead of JSON - Content-Type/Accept: application/cbor. Smaller on
+# the wire, and much lighter on the board's heap than ujson. Only what board requests
+# need: definite-length maps, arrays, strings, integers, floats, booleans and null - no tags.
+mimetype = "application/cbor"
+max_depth = 16
+float_formats = { 25: struct.Struct("!e"), 26: struct.Struct("!f"), 27: struct.Struct("!d") }
+
+def dumps(value) -> bytes:
+    out = bytearray()
+    encode(value, out)
+    return bytes(out)
+
+def head(major, length, out: bytearray):
+    if length < 24:
+        out.append(major << 5 | length)
+    elif length < 0x100:
+        out += bytes((major << 5 | 24, length))
+    elif length < 0x10000:
+        out.append(major << 5 | 25)
+        out += length.to_bytes(2, "big")
+    elif length < 0x100000000:
+        out.append(major << 5 | 26)
+        out += length.to_bytes(4, "big")
+    else:
+        out.append(major << 5 | 27)
+        out += length.to_bytes(8, "big")
+
+def encode(value, out: bytearray):
+    if value is None:
+        out.append(0xf6)
+    elif value is True:
+        out.append(0xf5)
+    elif value is False:
+        out.append(0xf4)
+    elif isinstance(value, int):
+        if value >= 0:
+            head(0, value, out)
+        else:
+            head(1, -1 - value, out)
+    elif isinstance(value, str):
+        text = value.encode('utf-8')
+        head(3, len(text), out)
+        out += text
+    elif isinstance(value, (bytes, bytearray)):
+        head(2, len(value), out)
+        out += value
+    elif isinstance(value, float):
+        out.append(0xfb)
+        out += struct.pack("!d", value)
+    elif isinstance(value, dict):
+        head(5, len(value), out)
+        for key, item in value.items():
+            encode(key, out)
+            encode(item, out)
+    elif isinstance(value, (list, tuple)):
+        head(4, len(value), out)
+        for item in value:
+            encode(item, out)
+    else:
+        raise TypeError(f"Can't encode {type(value).__name__} as CBOR")
+
+# Raises ValueError if the data isn't (supported) CBOR, or has anything after the item
+def loads(data: bytes):
+    value, position = decode(data, 0, 0)
+    if position != len(data):
+        raise ValueError("Trailing data after CBOR item")
+    return value
+
+def decode(data: bytes, position, depth):
+    if position >= len(data):
+        raise ValueError("Truncated CBOR data")
+    initial = data[position]
+    major, info = initial >> 5, initial & 0x1f
+    position += 1
+
+    if major == 7:
+        if info == 20:
+            return False, position
+        if info == 21:
+            return True, position
+        if info in (22, 23):
+            return None, position
+        float_format = float_formats.get(info)
+        if float_format is None or position + float_format.size > len(data):
+            raise ValueError("Unsupported or truncated CBOR simple value")
+        return float_format.unpack_from(data, position)[0], position + float_format.size
+
+    if info < 24:
+        length = info
+    elif info <= 27:
+        size = 1 << (info - 24)
+        if position + size > len(data):
+            raise ValueError("Truncated CBOR data")
+        length = int.from_bytes(data[position:position + size], "big")
+        position += size
+    else:
+        raise ValueError("Indefinite lengths are not supported")
+
+    if major == 0:
+        return length, position
+    if major == 1:
+        return -1 - length, position
+    if major in (2, 3):
+        if position + length > len(data):
+            raise ValueError("Truncated CBOR string")
+        raw = data[position:position + length]
+        return (bytes(raw) if major == 2 else raw.decode('utf-8')), position + length
+    if major == 6:
+        raise ValueError("CBOR tags are not supported")
+
+    if depth >= max_depth:
+        raise ValueError("CBOR data is nested too deep")
+    # every item takes at least a byte - don't let a length make us allocate more than that
+    if length > len(data) - position:
+        raise ValueError("Truncated CBOR container")
+    if major == 4:
+        items = []
+        for _ in range(length):
+            item, position = decode(data, position, depth + 1)
+            items.append(item)
+        return items, position
+    mapping = {}
+    size = len(data)
+    for _ in range(length):
+        # board requests are flat maps of short strings and small numbers - read those in place
+        initial = data[position] if position < size else None
+        if initial is not None and 0x60 <= initial < 0x78:
+            end = position + 1 + initial - 0x60
+            if end > size:
+                raise ValueError("Truncated CBOR string")
+            key, position = data[position + 1:end].decode('utf-8'), end
+        else:
+            key, position = decode(data, position, depth + 1)
+            if isinstance(key, (list, dict)):
+                raise ValueError("CBOR map keys must be scalars")
+
+        initial = data[position] if position < size else None
+        if initial is not None and initial < 0x18:
+            mapping[key], position = initial, position + 1
+        elif initial is not None and 0x60 <= initial < 0x78 and position + 1 + initial - 0x60 <= size:
+            end = position + 1 + initial - 0x60
+            mapping[key], position = data[position + 1:end].decode('utf-8'), end
+        else:
+            mapping[key], position = decode(data, position, depth + 1)
+    return mapping, position
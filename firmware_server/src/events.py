@@ -0,0 +1,67 @@
+import os
+import time
+import uuid
+from threading import Lock, Thread
+
+from util import state
+
+# Lets worker processes know what happened in the others (like an order being placed,
+# completed or expired). Events are appended to the shared storage, and every process
+# polls for the ones published by the others. Subscribers are called in every process,
+# including the one that published the event.
+poll_interval = float(os.environ.get("EVENT_POLL_INTERVAL", 0.5))
+retention = 600 # seconds events are kept for, long enough for any process to catch up
+
+class EventBus():
+    def __init__(self, storage):
+        self.storage = storage
+        self.subscribers: dict[str, list] = {}
+        self.pid = None
+        self.origin = None
+        self.cursor = 0
+        self.lock = Lock()
+
+    def subscribe(self, kind, callback):
+        self.subscribers.setdefault(kind, []).append(callback)
+
+    def publish(self, kind, data: dict):
+        if self.storage.shared:
+            self.start()
+            self.storage.append_event(self.origin, kind, data)
+        self.deliver(kind, data)
+
+    def deliver(self, kind, data: dict):
+        for callback in self.subscribers.get(kind, []):
+            try:
+                callback(data)
+            except Exception as e:
+                print(f"Handling '{kind}' event failed: {e}")
+
+    # Starts polling once per process - checked by pid, since a forked worker
+    # doesn't inherit the thread
+    def start(self):
+        if not self.storage.shared:
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.origin = f"{self.pid}-{uuid.uuid4().hex[:8]}"
+            self.cursor = self.storage.last_event_id() # only what happens from now on
+        Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        last_prune = time.monotonic()
+        while True:
+            time.sleep(poll_interval)
+            try:
+                for event_id, kind, data in self.storage.events_after(self.cursor, self.origin):
+                    self.cursor = event_id
+                    self.deliver(kind, data)
+                if time.monotonic() - last_prune > retention:
+                    self.storage.prune_events(retention)
+                    last_prune = time.monotonic()
+            except Exception as e:
+                print(f"Reading events failed: {e}")
+
+bus = EventBus(state["storage"])
@@ -0,0 +1,157 @@
+import json
+import os
+import queue
+import time
+from datetime import datetime
+from threading import Lock
+
+from flask import Response, jsonify, request
+
+from events import bus
+from registry import registry
+from scheduler import scheduler
+from util import state
+
+# How many boards run each firmware version, and how many are online - kept as counters
+# in storage instead of being counted from the boards every time, so a dashboard can ask
+# every second. A status (or a completed order) only puts the board's latest firmware
+# version in a buffer; every FLEET_FLUSH_SECONDS the buffer is written to storage, where
+# the counters move along with the boards whose version or liveness changed.
+# A board is offline once it missed MISSED_POLLS of its polls - its polling interval is
+# measured from its statuses (POLL_INTERVAL_SECONDS until then), or the next_poll it was
+# told if that is longer. Storage keeps the boards
+# ordered by that deadline, so finding the ones that went offline doesn't scan the fleet;
+# they are announced on the event bus, and streamed to whoever watches /firmware/fleet/events.
+# One process looks for them - while it holds the sweep lease, the others don't write at all.
+flush_interval = float(os.environ.get("FLEET_FLUSH_SECONDS", 1))
+missed_polls = int(os.environ.get("MISSED_POLLS", 3))
+poll_interval = float(os.environ.get("POLL_INTERVAL_SECONDS", 10))
+keepalive = 15 # seconds between comments on a quiet event stream, so proxies don't close it
+# Seconds before another process takes over the offline sweep from one that stopped
+sweep_lease = 10
+# Each event stream holds one of the worker's threads for as long as it is open
+max_watchers = int(os.environ.get("FLEET_WATCHERS", 1))
+
+class Fleet():
+    def __init__(self):
+        self.pending: dict[str, tuple[str, str, str, float, float]] = {} # board id -> latest status
+        self.lock = Lock()
+
+    # next_poll: when the board was told to send its next status, if it was
+    def seen(self, board_id, firmware, version, next_poll=0):
+        status = (board_id, firmware, version, time.time(), next_poll)
+        with self.lock:
+            self.pending[board_id] = status
+
+    def flush(self):
+        with self.lock:
+            statuses, self.pending = list(self.pending.values()), {}
+        if statuses:
+            back = state["storage"].save_seen(statuses, missed_polls, poll_interval)
+            if back:
+                print(f"{len(back)} boards came back online")
+                bus.publish("boards_online", { "boards": back })
+        if not state["storage"].claim_lease("offline_sweep", str(os.getpid()), sweep_lease):
+            return
+        offline = state["storage"].mark_offline(time.time())
+        if offline:
+            print(f"{len(offline)} boards went offline: {', '.join(seen.board_id for seen in offline[:10])}"
+                  f"{'...' if len(offline) > 10 else ''}")
+            bus.publish("boards_offline", { "boards": [seen.board_id for seen in offline] })
+
+    # Only reads the counters - they are at most FLEET_FLUSH_SECONDS behind, and reading
+    # doesn't wait on the write lock a flush would take
+    def counts(self) -> dict:
+        counts = state["storage"].fleet_counts()
+        liveness = counts["liveness"]
+        # registered boards that never sent a status
+        liveness["unseen"] = max(len(registry) - sum(liveness.values()), 0)
+        return { "boards": len(registry), "versions": counts["version"], "liveness": liveness }
+
+fleet = Fleet()
+
+# Clients watching boards go offline and come back, each with its own queue (per process)
+class Watchers():
+    def __init__(self, limit: int):
+        self.queues: set[queue.Queue] = set()
+        self.limit = limit
+        self.lock = Lock()
+
+    # None if this process already streams to as many clients as it may
+    def watch(self) -> None | queue.Queue:
+        events = queue.Queue(maxsize=1000)
+        with self.lock:
+            if len(self.queues) >= self.limit:
+                return None
+            self.queues.add(events)
+        return events
+
+    def unwatch(self, events: queue.Queue):
+        with self.lock:
+            self.queues.discard(events)
+
+    # A client too slow to keep up misses events rather than holding the others back
+    def send(self, kind, data: dict):
+        with self.lock:
+            queues = list(self.queues)
+        for events in queues:
+            try:
+                events.put_nowait((kind, data))
+            except queue.Full:
+                pass
+
+watchers = Watchers(max_watchers)
+bus.subscribe("boards_offline", lambda data: watchers.send("offline", data))
+bus.subscribe("boards_online", lambda data: watchers.send("online", data))
+
+def flush_periodically():
+    try:
+        fleet.flush()
+    except Exception as e:
+        print(f"Writing fleet counts failed: {e}")
+    scheduler.schedule(("fleet",), flush_interval, flush_periodically)
+
+# Called once per process (see startup.py)
+def start():
+    scheduler.schedule(("fleet",), flush_interval, flush_periodically)
+
+# Boards per firmware version and per liveness (online, offline, unseen) - client API
+def aggregates():
+    return jsonify(fleet.counts())
+
+# Offline boards, longest overdue first (at most ?limit=, 1000 by default) - client API
+def offline():
+    try:
+        limit = int(request.args.get("limit", 1000))
+    except ValueError:
+        return "'limit' must be a number", 400
+    if limit < 1:
+        return "'limit' must be a number of at least 1", 400
+    now = time.time()
+    return jsonify([{ "board_id": seen.board_id, "firmware": seen.firmware, "version": seen.version,
+                      "last_seen": datetime.fromtimestamp(seen.last_seen).isoformat(),
+                      "missed": int((now - seen.last_seen) // seen.interval) }
+                    for seen in state["storage"].offline_boards(limit)])
+
+# Boards going offline and coming back, as server-sent events ("offline"/"online",
+# with the ids of the boards) - client API. Only FLEET_WATCHERS clients per worker:
+# every stream keeps a thread busy, the others are turned away before they take one.
+def liveness_events():
+    events = watchers.watch()
+    if events is None:
+        return "Too many clients watching the fleet", 503, {"Retry-After": str(keepalive)}
+
+    def stream():
+        yield ": watching boards\n\n"
+        while True:
+            try:
+                kind, data = events.get(timeout=keepalive)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            yield f"event: {kind}\ndata: {json.dumps(data)}\n\n"
+
+    response = Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+    # also when the client is gone before the stream started
+    response.call_on_close(lambda: watchers.unwatch(events))
+    return response
@@ -0,0 +1,24 @@
+import multiprocessing
+import os
+
+# Production server: `gunicorn app:app` picks this file up from the working directory.
+# Every worker is a separate process with its own copy of the app - they share orders,
+# boards and rollouts through the STATE_DATABASE (see storage.py and events.py).
+bind = "0.0.0.0:8000"
+workers = int(os.environ.get("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+if not os.environ.get("STATE_DATABASE"):
+    workers = 1 # in-memory state can't be shared between processes
+
+# Status pings are short, but bundle downloads to boards on wifi are slow and mostly wait
+# on the network - threads keep one download from holding up a whole worker
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+# Boards poll on a timer, so keep their connections open a bit between requests
+keepalive = 5
+timeout = 60
+graceful_timeout = 30
+
+# Not preloaded: each worker opens its own database connections and starts its own
+# scheduler and event threads after forking
+preload_app = False
+accesslog = "-"
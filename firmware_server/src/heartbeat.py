@@ -0,0 +1,128 @@
+import hashlib
+import hmac
+import os
+import socket
+import struct
+from threading import Lock, Thread
+
+import update
+import util
+from registry import registry
+from util import state
+
+# Status pings as single UDP datagrams, for boards that can't spare an HTTP request
+# (a TCP connection, JSON both ways) every time. They go through the same status
+# pipeline as POST /firmware/status. The answer only says whether an update order is
+# pending and when to ping next - a board with an order asks for it over HTTP.
+#
+# Heartbeat, in network byte order:
+#   "FWHB" | layout version (1) | board id (16 bytes, zero padded)
+#   | firmware id (u32, the first 4 bytes of sha256("{firmware}-{version}")) | uptime (u32)
+#   | counter (u64, boot count << 32 | heartbeat number since boot) | tag (8 bytes)
+# Answer:
+#   "FWHA" | flags (1: update order pending) | next poll (u16 seconds) | counter | tag
+# Tags are HMAC-SHA256 over the rest, truncated - keyed per board with
+# HMAC-SHA256(HEARTBEAT_KEY, board id), see firmware/configure_boards.sh.
+# A heartbeat with a counter no later than the last one accepted from the board is a
+# replay, and dropped - the counters are kept in storage, so that holds across the worker
+# processes (which all listen on HEARTBEAT_PORT, with SO_REUSEPORT) and restarts.
+port = int(os.environ.get("HEARTBEAT_PORT") or 0)
+key = os.environ.get("HEARTBEAT_KEY", "")
+
+HEARTBEAT = struct.Struct("!4sB16sIIQ")
+ANSWER = struct.Struct("!4sBHQ")
+TAG_SIZE = 8
+ORDER_PENDING = 1
+
+def tag(board_key, message) -> bytes:
+    return hmac.new(board_key, message, hashlib.sha256).digest()[:TAG_SIZE]
+
+def firmware_id(firmware, version) -> int:
+    return int.from_bytes(hashlib.sha256(f"{firmware}-{version}".encode()).digest()[:4], "big")
+
+class Heartbeats():
+    def __init__(self):
+        self.counters: dict[str, int] = {} # last counter this process accepted, per board
+        self.keys: dict[str, bytes] = {}
+        self.firmware: dict[int, tuple[str, str]] = {} # firmware id -> (firmware, version)
+        self.listed = None # mtime of the firmware directory when it was last listed
+        self.lock = Lock()
+
+    def board_key(self, board_id) -> bytes:
+        board_key = self.keys.get(board_id)
+        if board_key is None:
+            board_key = self.keys[board_id] = hmac.new(key.encode(), board_id.encode(), hashlib.sha256).digest()
+        return board_key
+
+    # Firmware uploaded since the last lookup is found by looking again - only when the
+    # firmware directory changed, so a board running unknown firmware doesn't have it listed
+    # on every heartbeat
+    def firmware_for(self, id) -> None | tuple[str, str]:
+        if id not in self.firmware:
+            listed = os.stat(state["firmware_directory"]).st_mtime_ns
+            if listed == self.listed:
+                return None
+            self.listed = listed
+            available = util.available_firmware(util.FirmwareInfoRequest())
+            for firmware, versions in available.lists():
+                for version in versions:
+                    self.firmware[firmware_id(firmware, version)] = (firmware, version)
+        return self.firmware.get(id)
+
+    # The answer to a heartbeat - None to drop it
+    def handle(self, packet: bytes) -> None | bytes:
+        if len(packet) != HEARTBEAT.size + TAG_SIZE:
+            return None
+        body, received_tag = packet[:HEARTBEAT.size], packet[HEARTBEAT.size:]
+        magic, layout, raw_id, fw_id, uptime, counter = HEARTBEAT.unpack(body)
+        if magic != b"FWHB" or layout != 1:
+            return None
+        board_id = raw_id.rstrip(b"\0").decode('utf-8', errors='replace')
+        if board_id not in registry:
+            return None
+        board_key = self.board_key(board_id)
+        if not hmac.compare_digest(tag(board_key, body), received_tag):
+            print(f"Heartbeat with a bad tag for board '{board_id}'")
+            return None
+        # replays this process has seen are dropped without asking storage
+        with self.lock:
+            if counter <= self.counters.get(board_id, 0):
+                return None
+        if not state["storage"].accept_heartbeat(board_id, counter):
+            print(f"Replayed heartbeat for board '{board_id}'")
+            return None
+        with self.lock:
+            self.counters[board_id] = max(counter, self.counters.get(board_id, 0))
+
+        # firmware the server doesn't have (flashed by hand, say) still counts as a status
+        firmware, version = self.firmware_for(fw_id) or ("unknown", f"{fw_id:08x}")
+        answer = update.handle_status(update.Status(firmware=firmware, version=version,
+                                                    board_id=board_id, uptime=uptime))
+        flags = ORDER_PENDING if answer.get("update") else 0
+        reply = ANSWER.pack(b"FWHA", flags, min(answer["next_poll"], 0xffff), counter)
+        return reply + tag(board_key, reply)
+
+heartbeats = Heartbeats()
+
+def listen(sock: socket.socket):
+    while True:
+        try:
+            packet, address = sock.recvfrom(512)
+            reply = heartbeats.handle(packet)
+            if reply:
+                sock.sendto(reply, address)
+        except Exception as e:
+            print(f"Handling heartbeat failed: {e}")
+
+# Called once per process (see startup.py)
+def start():
+    if not port:
+        return
+    if not key:
+        print("HEARTBEAT_PORT is set without a HEARTBEAT_KEY, not listening for heartbeats")
+        return
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    Thread(target=listen, args=(sock,), daemon=True).start()
+    print(f"Listening for heartbeats on UDP port {port}")
@@ -0,0 +1,181 @@
+import os
+import time
+from array import array
+from datetime import datetime
+from threading import Lock
+
+from flask import jsonify, request
+
+from registry import registry
+from scheduler import scheduler
+from storage import StatusWindow
+from util import state
+
+# What the boards' statuses said over time - when each was last seen, which firmware
+# versions the fleet ran, and when boards rebooted.
+# Every board gets a fixed-size ring buffer of its latest statuses, kept as typed arrays
+# (time, uptime and firmware version) instead of objects, so a board costs the same
+# kilobyte or so however often it pings. Every HISTORY_FLUSH_SECONDS the statuses
+# since the last flush are summed up into windows of HISTORY_WINDOW_SECONDS per board and
+# written to storage, where they are kept for HISTORY_RETENTION_DAYS.
+# Each process only buffers the statuses it answered, and queries only read storage, where
+# the windows of all processes add up - so they can be up to HISTORY_FLUSH_SECONDS behind.
+capacity = int(os.environ.get("HISTORY_SAMPLES", 32))
+flush_interval = float(os.environ.get("HISTORY_FLUSH_SECONDS", 60))
+window_length = int(os.environ.get("HISTORY_WINDOW_SECONDS", 300))
+retention = float(os.environ.get("HISTORY_RETENTION_DAYS", 7)) * 24 * 3600
+boot_tolerance = 30 # seconds two estimates of when a board booted can differ by and still be the same boot
+max_boots = 16 # per window, for a board stuck rebooting
+
+class BoardHistory():
+    def __init__(self):
+        self.times = array('d', bytes(8 * capacity))
+        self.uptimes = array('q', bytes(8 * capacity))
+        self.versions = array('I', bytes(4 * capacity)) # index into HistoryStore.versions
+        self.count = 0 # statuses ever recorded, the next one goes at count % capacity
+        self.flushed = 0 # statuses already written out
+
+    def append(self, when, uptime, version):
+        position = self.count % capacity
+        self.times[position], self.uptimes[position], self.versions[position] = when, uptime, version
+        self.count += 1
+
+    # Positions of the statuses recorded since the given count that are still in the buffer, oldest first
+    def since(self, count) -> list[int]:
+        return [index % capacity for index in range(max(count, self.count - capacity), self.count)]
+
+class HistoryStore():
+    def __init__(self):
+        self.boards: dict[str, BoardHistory] = {}
+        self.versions: list[tuple[str, str]] = [] # (firmware, version), stored once
+        self.version_ids: dict[tuple[str, str], int] = {}
+        self.dirty: set[str] = set() # boards with statuses that weren't flushed yet
+        self.lock = Lock()
+        self.last_prune = 0
+
+    def record(self, board_id, firmware, version, uptime):
+        key = (firmware, version)
+        with self.lock:
+            version_id = self.version_ids.get(key)
+            if version_id is None:
+                version_id = self.version_ids[key] = len(self.versions)
+                self.versions.append(key)
+            board = self.boards.get(board_id)
+            if board is None:
+                board = self.boards[board_id] = BoardHistory()
+            board.append(time.time(), min(max(uptime, 0), 2**63 - 1), version_id)
+            self.dirty.add(board_id)
+
+    # The statuses since the last flush, as windows - a board that pinged more often than
+    # the buffer holds between flushes still has all of its statuses counted
+    def take_windows(self) -> list[StatusWindow]:
+        windows = []
+        with self.lock:
+            for board_id in self.dirty:
+                board = self.boards[board_id]
+                positions = board.since(board.flushed)
+                lost = board.count - board.flushed - len(positions)
+                board.flushed = board.count
+                by_start: dict[float, StatusWindow] = {}
+                for position in positions:
+                    when, uptime = board.times[position], board.uptimes[position]
+                    firmware, version = self.versions[board.versions[position]]
+                    started = when - when % window_length
+                    window = by_start.get(started)
+                    if window is None:
+                        window = by_start[started] = StatusWindow(
+                            board_id=board_id, started=started, ended=when, samples=lost,
+                            firmware=firmware, version=version, uptime=uptime)
+                        lost = 0
+                    window.samples += 1
+                    window.ended, window.firmware, window.version, window.uptime = when, firmware, version, uptime
+                    add_boot(window.boots, when - uptime)
+                windows += by_start.values()
+            self.dirty = set()
+        return windows
+
+    # Writes out the statuses since the last flush, and drops windows past retention
+    def flush(self):
+        windows = self.take_windows()
+        if windows:
+            state["storage"].save_windows(windows)
+        if time.time() - self.last_prune > 3600:
+            self.last_prune = time.time()
+            state["storage"].prune_windows(time.time() - retention)
+
+# A board's uptime going back (its boot time moving by more than the clocks' jitter)
+# means it rebooted in between. Estimates are compared to the latest one of the same boot,
+# so the board's clock drifting slowly doesn't look like a reboot.
+def add_boot(boots: list[float], boot, limit=max_boots):
+    boot = round(boot, 1)
+    if boots and abs(boots[-1] - boot) <= boot_tolerance:
+        boots[-1] = boot
+    elif len(boots) < limit:
+        boots.append(boot)
+
+history = HistoryStore()
+
+def flush_periodically():
+    try:
+        history.flush()
+    except Exception as e:
+        print(f"Writing status history failed: {e}")
+    scheduler.schedule(("history",), flush_interval, flush_periodically)
+
+# Called once per process (see startup.py)
+def start():
+    scheduler.schedule(("history",), flush_interval, flush_periodically)
+
+def timestamp(when) -> None | str:
+    return datetime.fromtimestamp(when).isoformat() if when is not None else None
+
+# A numeric query parameter, within reason
+def number_arg(name, default, maximum) -> float:
+    value = float(request.args.get(name, default))
+    if not 0 < value <= maximum:
+        raise ValueError(f"'{name}' must be between 0 and {maximum}")
+    return value
+
+# When a board last sent its status, and what it said - client API
+def last_seen(id):
+    if id not in registry:
+        return f"Unknown board ID: {id}", 404
+    window = state["storage"].last_window(id)
+    if not window:
+        return jsonify({ "board_id": id, "last_seen": None })
+    return jsonify({ "board_id": id, "last_seen": timestamp(window.ended), "firmware": window.firmware,
+                     "version": window.version, "uptime": window.uptime })
+
+# When a board booted over the last ?hours= (24 by default), and how many times it rebooted
+# (its uptime went back) - client API
+def reboots(id):
+    if id not in registry:
+        return f"Unknown board ID: {id}", 404
+    try:
+        hours = number_arg("hours", 24, retention / 3600)
+    except ValueError as e:
+        return str(e), 400
+    boots = []
+    # windows written by different processes saw the same boot at slightly different times
+    for boot in sorted(boot for window in state["storage"].load_windows(id, time.time() - hours * 3600)
+                       for boot in window.boots):
+        add_boot(boots, boot, limit=1000)
+    return jsonify({ "board_id": id, "boots": [timestamp(boot) for boot in boots],
+                     "reboots": max(len(boots) - 1, 0) })
+
+# How many boards ran each firmware version over the last ?hours= (24 by default),
+# per ?bucket= seconds (an hour by default) - client API
+def versions():
+    try:
+        hours = number_arg("hours", 24, retention / 3600)
+        bucket = number_arg("bucket", 3600, hours * 3600)
+    except ValueError as e:
+        return str(e), 400
+    if bucket < window_length or hours * 3600 / bucket > 1000:
+        return f"'bucket' must be at least {window_length} seconds, and at most 1000 buckets long", 400
+    since = time.time() - hours * 3600
+    counts = state["storage"].version_counts(since, bucket)
+    return jsonify([{ "start": timestamp(since + index * bucket),
+                      "versions": { f"{firmware}-{version}": boards
+                                    for (firmware, version), boards in counts.get(index, {}).items() } }
+                    for index in range(int(hours * 3600 // bucket) + 1)])
@@ -0,0 +1,138 @@
+import hashlib
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from pydantic import BaseModel
+
+from util import state
+
+# Per-file sha256 manifests, computed once when firmware is uploaded, and stored
+# next to the firmware directory as {firmware}-{version}.manifest.json
+block_size = 64 * 1024
+
+class FileDigest(BaseModel):
+    sha256: str
+    size: int
+
+class FirmwareManifest(BaseModel):
+    firmware: str
+    version: str
+    files: dict[str, FileDigest]
+    fingerprint: str = "" # directory_fingerprint() of the files when they were hashed
+
+def calculate_shasum(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+# Cheap change detection - only stats the files, doesn't read them
+def directory_fingerprint(firmware_dir):
+    sha = hashlib.sha256()
+    for entry in sorted(os.scandir(firmware_dir), key=lambda e: e.name):
+        if entry.is_file():
+            stat = entry.stat()
+            sha.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns};".encode('utf-8'))
+    return sha.hexdigest()
+
+def manifest_path(firmware, version):
+    return os.path.join(state["firmware_directory"], f"{firmware}-{version}.manifest.json")
+
+# Copies an uploaded file to disk, hashing it on the way
+def save_and_hash(stream, path) -> FileDigest:
+    sha = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    with open(path, 'wb') as f:
+        for block in iter(lambda: stream.read(block_size), b''):
+            sha.update(block)
+            size += len(block)
+            f.write(block)
+    return FileDigest(sha256=sha.hexdigest(), size=size)
+
+def write_manifest(manifest: FirmwareManifest):
+    path = manifest_path(manifest.firmware, manifest.version)
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w') as f:
+        f.write(manifest.model_dump_json(indent=2))
+    os.replace(tmp_path, path)
+
+def read_manifest(firmware, version) -> None | FirmwareManifest:
+    try:
+        with open(manifest_path(firmware, version), 'r') as f:
+            return FirmwareManifest.model_validate_json(f.read())
+    except (OSError, ValueError):
+        return None
+
+def compute_manifest(firmware, version, firmware_dir) -> FirmwareManifest:
+    # taken before hashing, so a file changed meanwhile makes the next lookup rehash
+    fingerprint = directory_fingerprint(firmware_dir)
+    files = {}
+    for file in sorted(os.listdir(firmware_dir)):
+        path = os.path.join(firmware_dir, file)
+        if os.path.isfile(path):
+            files[file] = FileDigest(sha256=calculate_shasum(path), size=os.path.getsize(path))
+    return FirmwareManifest(firmware=firmware, version=version, files=files, fingerprint=fingerprint)
+
+# Returns the stored manifest, if the files haven't changed (names, sizes, mtimes) since
+# it was computed. Otherwise (firmware copied in by hand, or edited on disk - even to the
+# same size) it is recomputed and stored.
+def get_manifest(firmware, version, firmware_dir, fingerprint=None) -> FirmwareManifest:
+    if fingerprint is None:
+        fingerprint = directory_fingerprint(firmware_dir)
+    manifest = read_manifest(firmware, version)
+    if manifest:
+        if manifest.fingerprint == fingerprint:
+            return manifest
+        print(f"Stored manifest for '{firmware}-{version}' is out of date, recomputing")
+    manifest = compute_manifest(firmware, version, firmware_dir)
+    write_manifest(manifest)
+    return manifest
+
+# Re-hashes the files of a firmware version and compares them with its stored manifest.
+# Returns a list of problems - empty if everything matches.
+def verify_manifest(firmware, version) -> list[str]:
+    name = f"{firmware}-{version}"
+    firmware_dir = os.path.join(state["firmware_directory"], name)
+    manifest = read_manifest(firmware, version)
+    if not manifest:
+        return [f"{name}: no manifest"]
+    actual = compute_manifest(firmware, version, firmware_dir).files
+
+    problems = []
+    for file, digest in manifest.files.items():
+        if file not in actual:
+            problems.append(f"{name}: {file} is missing")
+        elif actual[file] != digest:
+            problems.append(f"{name}: {file} does not match its manifest")
+    for file in actual.keys() - manifest.files.keys():
+        problems.append(f"{name}: {file} is not in the manifest")
+    return problems
+
+# Verifies every stored firmware version (or the given '{firmware}-{version}'s)
+# Usage: python manifests.py [firmware-version ...]
+def main(names) -> int:
+    if not names:
+        names = [entry.name for entry in os.scandir(state["firmware_directory"])
+                 if entry.is_dir() and entry.name != "keys"]
+    versions = [name.rsplit('-', 1) for name in sorted(names)]
+
+    with ThreadPoolExecutor() as pool:
+        results = pool.map(lambda fw: verify_manifest(*fw), versions)
+
+    failed = 0
+    for (firmware, version), problems in zip(versions, results):
+        if problems:
+            failed += 1
+            for problem in problems:
+                print(problem)
+        else:
+            print(f"{firmware}-{version}: OK")
+    print(f"{len(versions) - failed}/{len(versions)} firmware versions verified")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    state["firmware_directory"] = os.environ["FIRMWARE_DIRECTORY"]
+    sys.exit(main(sys.argv[1:]))
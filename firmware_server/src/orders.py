@@ -0,0 +1,85 @@
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from pydantic import BaseModel
+
+time_to_expiry = timedelta(minutes=int(os.environ["UPDATE_EXPIRACY_MINUTES"]))
+
+# Info for update orders - terminated by expiration or completion
+# Stored in state["orders"] (an OrderStore) for one order/board at a time
+class UpdateOrder(BaseModel):
+    board_id: str
+    firmware: str
+    version: str
+    secret: str
+    expiration: datetime = datetime.now()
+    generation: int = 0 # set by the OrderStore, changes every time an order is (re)placed
+    rollout: Optional[str] = None # id of the group rollout the order is part of
+
+    # Automatic expiration creation
+    def __init__(self, **data):
+        super().__init__(**data)
+        self.expiration = datetime.now() + time_to_expiry;
+
+class OrderExists(Exception):
+    def __init__(self, board_id):
+        super().__init__(f"Update Order already exists for '{board_id}'!\nUse PUT to overwrite.")
+
+# All update orders, by board id, kept in a storage backend (see storage.py).
+# Every operation is atomic, and completing/expiring an order only succeeds for the
+# generation it was meant for - so a late expiry or confirmation of a replaced order
+# can't remove its replacement.
+# Listeners are called with every order that ends, and how:
+# "completed", "expired" or "replaced".
+class OrderStore():
+    def __init__(self, storage):
+        self.storage = storage
+        self.listeners = []
+
+    def on_finished(self, listener):
+        self.listeners.append(listener)
+
+    def finished(self, order: UpdateOrder, outcome):
+        for listener in self.listeners:
+            listener(order, outcome)
+
+    def __contains__(self, board_id):
+        return self.storage.get_order(board_id) is not None
+
+    def __len__(self):
+        return self.storage.count_orders()
+
+    def get(self, board_id) -> None | UpdateOrder:
+        return self.storage.get_order(board_id)
+
+    # The orders of the given boards (that have one), by board id
+    def get_many(self, board_ids: list[str]) -> dict[str, UpdateOrder]:
+        return self.storage.get_orders(board_ids)
+
+    # Orders that haven't ended yet, soonest expiration first
+    def pending(self) -> list[UpdateOrder]:
+        return self.storage.pending_orders()
+
+    # Adds the order (assigning its generation), returns the order it replaced, if any
+    def add(self, order: UpdateOrder, overwrite=False) -> None | UpdateOrder:
+        # raises OrderExists if there is an order and overwrite isn't set
+        previous = self.storage.put_order(order, overwrite)
+        if previous:
+            self.finished(previous, "replaced")
+        return previous
+
+    # Removes the order if it is still the given generation (any, if None), returns it
+    def remove(self, board_id, generation, outcome) -> None | UpdateOrder:
+        order = self.storage.remove_order(board_id, generation)
+        if order:
+            self.finished(order, outcome)
+        return order
+
+    # Installed successfully
+    def complete(self, board_id, generation=None) -> None | UpdateOrder:
+        return self.remove(board_id, generation, "completed")
+
+    # Expiration reached - always for a specific generation
+    def expire(self, board_id, generation) -> None | UpdateOrder:
+        return self.remove(board_id, generation, "expired")
@@ -0,0 +1,40 @@
+import os
+import random
+import time
+from threading import Lock
+
+# When a board should send its next status (the next_poll in status answers, in seconds).
+# Boards with an order come back soon, in case installing it fails. The rest wait
+# POLL_IDLE_SECONDS, stretched when the process answers more than STATUS_RATE_TARGET
+# statuses a second, up to POLL_MAX_SECONDS. Every hint is jittered, so boards that
+# started together (after a power cut, say) drift apart instead of pinging in lockstep.
+order_interval = float(os.environ.get("POLL_ORDER_SECONDS", 5))
+idle_interval = float(os.environ.get("POLL_IDLE_SECONDS", 60))
+max_interval = float(os.environ.get("POLL_MAX_SECONDS", 600))
+target_rate = float(os.environ.get("STATUS_RATE_TARGET", 200))
+jitter = 0.2 # +- share of the interval
+
+# Statuses per second answered by this process, smoothed over the last few seconds
+class StatusRate():
+    def __init__(self):
+        self.rate = 0.0
+        self.count = 0
+        self.started = time.monotonic()
+        self.lock = Lock()
+
+    def add(self, statuses=1):
+        with self.lock:
+            self.count += statuses
+            now = time.monotonic()
+            if now - self.started >= 1:
+                self.rate = (self.rate + self.count / (now - self.started)) / 2
+                self.count, self.started = 0, now
+
+rate = StatusRate()
+
+def next_poll(ordered=False) -> int:
+    if ordered:
+        interval = order_interval
+    else:
+        interval = min(idle_interval * max(1, rate.rate / target_rate), max_interval)
+    return min(max(1, round(interval * random.uniform(1 - jitter, 1 + jitter))), round(max_interval))
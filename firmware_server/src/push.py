@@ -0,0 +1,48 @@
+import asyncio
+import os
+from threading import Lock
+
+from events import bus
+
+# Boards listening on the push channel (GET /firmware/push/<board_id>, server-sent events
+# from the ASGI app) are told about their update order as soon as it is placed, instead
+# of on their next status. Orders placed in any process reach them through the event bus.
+# Each connection has a queue on its own event loop; the bus calls in from its thread.
+keepalive = float(os.environ.get("PUSH_KEEPALIVE_SECONDS", 30))
+
+class Channels():
+    def __init__(self):
+        self.boards: dict[str, set[tuple[asyncio.AbstractEventLoop, asyncio.Queue]]] = {}
+        self.lock = Lock()
+
+    # Called on the connection's event loop
+    def open(self, board_id) -> tuple[asyncio.AbstractEventLoop, asyncio.Queue]:
+        channel = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            self.boards.setdefault(board_id, set()).add(channel)
+        return channel
+
+    def close(self, board_id, channel):
+        with self.lock:
+            channels = self.boards.get(board_id, set())
+            channels.discard(channel)
+            if not channels:
+                self.boards.pop(board_id, None)
+
+    # None hangs up
+    def send(self, channel, message: None | dict):
+        loop, queue = channel
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, message)
+        except RuntimeError: # the loop is gone (the worker is shutting down)
+            pass
+
+    def notify(self, board_id, message: dict):
+        with self.lock:
+            channels = list(self.boards.get(board_id, ()))
+        for channel in channels:
+            self.send(channel, message)
+
+channels = Channels()
+# the same notice the board would get in answer to its status
+bus.subscribe("order_added", lambda data: channels.notify(data["board_id"], { "update": True, "secret": data["secret"] }))
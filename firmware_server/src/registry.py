@@ -0,0 +1,150 @@
+import csv
+import io
+import json
+import os
+
+from flask import jsonify
+from pydantic import ValidationError
+
+import util
+from events import bus
+from storage import BoardRecord
+from util import state
+
+# The boards the server knows, kept in storage and indexed in memory (by id, tag and site)
+# in every process, so checking a board is a dict lookup.
+# Boards are added with a signed import (boards.csv or boards.json) - every process
+# reloads its index when one happens, no restart needed.
+class Registry():
+    def __init__(self):
+        self.boards: dict[str, BoardRecord] = {}
+        self.test_ids: set[str] = set()
+        self.tags: dict[str, list[str]] = {}
+        self.sites: dict[str, list[str]] = {}
+
+    def __contains__(self, board_id):
+        return board_id in self.boards
+
+    def __len__(self):
+        return len(self.boards)
+
+    def get(self, board_id) -> None | BoardRecord:
+        return self.boards.get(board_id)
+
+    def is_test(self, board_id):
+        return board_id in self.test_ids
+
+    def ids(self) -> list[str]:
+        return list(self.boards)
+
+    def tagged(self, tag) -> list[str]:
+        return self.tags.get(tag, [])
+
+    def at_site(self, site) -> list[str]:
+        return self.sites.get(site, [])
+
+    # The indexes are built on the side and swapped in, so lookups don't need a lock
+    def load(self, boards: list[BoardRecord]):
+        by_id, test_ids, tags, sites = {}, set(), {}, {}
+        for board in boards:
+            by_id[board.board_id] = board
+            if board.test:
+                test_ids.add(board.board_id)
+            for tag in board.tags:
+                tags.setdefault(tag, []).append(board.board_id)
+            if board.site:
+                sites.setdefault(board.site, []).append(board.board_id)
+        self.boards, self.test_ids, self.tags, self.sites = by_id, test_ids, tags, sites
+
+    def reload(self):
+        self.load(state["storage"].load_boards())
+
+registry = Registry()
+bus.subscribe("boards_changed", lambda data: registry.reload())
+
+# Registers the boards from the environment (defined in the Dockerfile) on top of the
+# stored ones: KNOWN_IDS, KNOWN_TEST_IDS, and BOARD_TAGS formatted as tag=id,id:other_tag=id
+def load_environment():
+    stored = { board.board_id: board for board in state["storage"].load_boards() }
+    boards: dict[str, BoardRecord] = {}
+    def board(board_id):
+        if board_id not in boards:
+            boards[board_id] = stored.get(board_id, BoardRecord(board_id=board_id))
+        return boards[board_id]
+
+    for board_id in filter(None, os.environ["KNOWN_IDS"].split(':')):
+        board(board_id).test = False
+    for board_id in filter(None, os.environ["KNOWN_TEST_IDS"].split(':')):
+        board(board_id).test = True
+    for tag_ids in filter(None, os.environ.get("BOARD_TAGS", "").split(':')):
+        tag, ids = tag_ids.split('=', 1)
+        for board_id in ids.split(','):
+            if tag not in board(board_id).tags:
+                board(board_id).tags.append(tag)
+
+    state["storage"].import_boards(list(boards.values()))
+    registry.reload()
+
+# boards.csv has a header row with board_id and optionally test, site and tags
+# (separated by ';'), boards.json is a list of objects with the same fields
+def parse_boards(filename, text) -> list[BoardRecord]:
+    if filename.endswith(".json"):
+        rows = json.loads(text)
+    else:
+        rows = []
+        for row in csv.DictReader(io.StringIO(text)):
+            row = { key: value.strip() for key, value in row.items() if key and value and value.strip() }
+            if "test" in row:
+                row["test"] = row["test"].lower() in ["1", "true", "yes"]
+            if "tags" in row:
+                row["tags"] = [tag.strip() for tag in row["tags"].split(';') if tag.strip()]
+            rows.append(row)
+    if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+        raise ValueError("Expected a list of boards")
+    return [BoardRecord(board_id=row["board_id"], test=row.get("test", False),
+                        site=row.get("site"), tags=row.get("tags", []))
+            for row in rows]
+
+# Bulk board import - client API
+# Expects boards.csv or boards.json, and its signature. Boards already registered are
+# updated (test, site and tags), the rest are added.
+def import_boards():
+    try:
+        signature, other_files = util.sort_files(['csv', 'json'])
+    except Exception as e:
+        return e.args
+
+    if not signature:
+        print("Board import without a signature")
+        return "No signature file found!", 422
+    files = [name for name in other_files if name in ["boards.csv", "boards.json"]]
+    if len(files) != 1:
+        print("Board import without a board list")
+        return "Include the board list (boards.csv or boards.json) in your request", 400
+
+    try:
+        text = other_files[files[0]].read().decode('utf-8')
+    except UnicodeDecodeError:
+        print("Board list that isn't UTF-8 received")
+        return "The board list must be UTF-8 text", 400
+    if not util.find_signer(signature, text):
+        print("Bad signature!")
+        return "Invalid or unknown signature", 401
+
+    try:
+        boards = parse_boards(files[0], text)
+    except (KeyError, ValueError, ValidationError) as e:
+        print("Bad board list received")
+        return f"Bad board list: {e}", 400
+
+    state["storage"].import_boards(boards)
+    bus.publish("boards_changed", { "count": len(boards) })
+    print(f"Imported {len(boards)} boards, {len(registry)} registered")
+    return jsonify({ "imported": len(boards), "boards": len(registry) })
+
+# Registration of one board - client API
+def board_info(id):
+    if id not in registry:
+        return f"Unknown board ID: {id}", 404
+    # from storage, for the firmware last installed
+    return jsonify(state["storage"].get_board(id).model_dump(mode="json"))
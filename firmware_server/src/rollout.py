@@ -0,0 +1,259 @@
+import fnmatch
+import hashlib
+import json
+import os
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Optional
+
+from flask import jsonify, request
+from pydantic import BaseModel, ValidationError, model_validator
+
+import util
+from orders import UpdateOrder
+from registry import registry
+from scheduler import scheduler
+from update import add_order
+from util import state
+
+# Group update orders: one signed manifest selects a set of boards, which are given
+# update orders in waves, so a big rollout neither needs a signature per board
+# nor has every board hit the download endpoint at once.
+default_concurrency = int(os.environ.get("ROLLOUT_CONCURRENCY", 100))
+
+# The signed rollout.json sent by the client
+class RolloutRequest(BaseModel):
+    firmware: str
+    version: str
+    # Exactly one board selector
+    boards: Optional[list[str]] = None # explicit ids
+    tag: Optional[str] = None # boards with this tag
+    site: Optional[str] = None # boards at this site
+    glob: Optional[str] = None # ids matching this pattern, like "site-a-*"
+    # At most this many orders are outstanding at a time
+    concurrency: int = default_concurrency
+    # Boards per wave (default: concurrency), and minimum seconds between waves.
+    # With no interval, the next boards are released as soon as orders finish.
+    wave_size: Optional[int] = None
+    wave_interval: float = 0
+
+    @model_validator(mode='after')
+    def one_selector(self):
+        selectors = [self.boards, self.tag, self.site, self.glob]
+        if sum(selector is not None for selector in selectors) != 1:
+            raise ValueError("Select boards with exactly one of 'boards', 'tag', 'site' or 'glob'")
+        if self.concurrency < 1 or (self.wave_size is not None and self.wave_size < 1):
+            raise ValueError("Concurrency and wave size must be at least 1")
+        return self
+
+class Rollout():
+    def __init__(self, id, req: RolloutRequest, board_ids: list[str], secret_seed: bytes):
+        self.id = id
+        self.firmware = req.firmware
+        self.version = req.version
+        self.concurrency = req.concurrency
+        self.wave_size = req.wave_size or req.concurrency
+        self.wave_interval = req.wave_interval
+        self.secret_seed = secret_seed
+        self.total = len(board_ids)
+        self.released = 0 # boards given their orders, from the start of board_ids
+        self.in_flight: set[str] = set()
+        self.outcomes = { "completed": 0, "expired": 0, "replaced": 0 }
+        self.next_wave = 0.0 # time.time() at which the next wave may go out
+        self.lock = Lock()
+
+    # Everything (but the boards) needed to pick the rollout up in another process, or after
+    # a restart. Stored on every change, so it stays small: the boards left are the ones past
+    # released, and no more than concurrency are in flight.
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "firmware": self.firmware,
+            "version": self.version,
+            "concurrency": self.concurrency,
+            "wave_size": self.wave_size,
+            "wave_interval": self.wave_interval,
+            "secret_seed": self.secret_seed.hex(),
+            "total": self.total,
+            "released": self.released,
+            "in_flight": list(self.in_flight),
+            "outcomes": self.outcomes,
+            "next_wave": self.next_wave,
+        }
+
+    def load(self, data: dict):
+        self.total = data["total"]
+        self.released = data["released"]
+        self.in_flight = set(data["in_flight"])
+        self.outcomes = data["outcomes"]
+        self.next_wave = data.get("next_wave", 0.0)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        req = RolloutRequest(firmware=data["firmware"], version=data["version"], boards=[],
+                             concurrency=data["concurrency"], wave_size=data["wave_size"],
+                             wave_interval=data["wave_interval"])
+        rollout = cls(data["id"], req, [], bytes.fromhex(data["secret_seed"]))
+        rollout.load(data)
+        return rollout
+
+    # Runs the block on the latest stored progress of the rollout, and stores it back after.
+    # Any worker process may be handling the rollout's orders, so this is the only way
+    # its progress is changed.
+    @contextmanager
+    def transaction(self):
+        with self.lock, state["storage"].rollout_transaction(self.id) as stored:
+            if stored["data"] is not None:
+                self.load(stored["data"])
+            yield
+            stored["data"] = self.to_dict()
+
+    def status(self):
+        with self.lock:
+            return {
+                "id": self.id,
+                "firmware": self.firmware,
+                "version": self.version,
+                "total": self.total,
+                "pending": self.pending(),
+                "in_flight": len(self.in_flight),
+                **self.outcomes,
+            }
+
+    def pending(self) -> int:
+        return self.total - self.released
+
+    # Each board gets its own secret, even though they share a signature
+    def secret(self, board_id):
+        return hashlib.md5(self.secret_seed + board_id.encode('utf-8')).hexdigest()
+
+    # Gives the next wave of boards their orders, as far as the concurrency cap
+    # (and the wave interval) allows
+    def release(self):
+        wave = []
+        with self.transaction():
+            if time.time() >= self.next_wave:
+                count = min(self.wave_size, self.concurrency - len(self.in_flight), self.pending())
+                wave = state["storage"].rollout_boards(self.id, self.released, count)
+                self.released += count
+                self.in_flight.update(wave)
+                if wave and self.wave_interval:
+                    self.next_wave = time.time() + self.wave_interval
+
+        for board_id in wave:
+            order = UpdateOrder(board_id=board_id, firmware=self.firmware, version=self.version,
+                                secret=self.secret(board_id), rollout=self.id)
+            add_order(order, overwrite=True) # the rollout supersedes single orders
+        if wave:
+            print(f"Rollout '{self.id}': released {len(wave)} orders, {self.pending()} boards left")
+
+        # Every process may have this timer - whichever comes first releases the wave
+        if self.pending() and self.wave_interval:
+            delay = max(self.next_wave - time.time(), 0) or self.wave_interval
+            scheduler.schedule(("rollout", self.id), delay, self.release)
+
+    def order_finished(self, order: UpdateOrder, outcome):
+        with self.transaction():
+            if order.board_id not in self.in_flight:
+                return
+            self.in_flight.discard(order.board_id)
+            self.outcomes[outcome] += 1
+            done = not self.pending() and not self.in_flight
+        if done:
+            print(f"Rollout '{self.id}' finished: {self.outcomes}")
+        elif not self.wave_interval:
+            self.release()
+
+def get_rollout(rollout_id) -> None | Rollout:
+    data = state["storage"].get_rollout(rollout_id)
+    return Rollout.from_dict(data) if data else None
+
+# Called for every order that ends (in the process that ended it), passes it on to its rollout
+def order_finished(order: UpdateOrder, outcome):
+    if order.rollout:
+        rollout = get_rollout(order.rollout)
+        if rollout:
+            rollout.order_finished(order, outcome)
+
+state["orders"].on_finished(order_finished)
+
+# Picks up the stored rollouts when a process starts - their orders are rescheduled by
+# update.rehydrate_orders, and the boards still pending get released as usual
+def restore_rollouts():
+    for data in state["storage"].load_rollouts():
+        rollout = Rollout.from_dict(data)
+        if rollout.pending():
+            print(f"Resuming rollout '{rollout.id}', {rollout.pending()} boards left")
+            rollout.release()
+
+def select_boards(req: RolloutRequest) -> list[str]:
+    if req.boards is not None:
+        return list(dict.fromkeys(req.boards)) # deduplicated, in order
+    if req.tag is not None:
+        return registry.tagged(req.tag)
+    if req.site is not None:
+        return registry.at_site(req.site)
+    return fnmatch.filter(registry.ids(), req.glob)
+
+# Group update order - client API
+# Expects rollout.json (a RolloutRequest) and its signature
+def create():
+    try:
+        signature, other_files = util.sort_files(['json'])
+    except Exception as e:
+        return e.args
+
+    if not signature:
+        print("Rollout ordered without a signature")
+        return "No signature file found!", 422
+    if "rollout.json" not in other_files:
+        print("Rollout ordered without rollout.json")
+        return "Include the rollout manifest (rollout.json) in your request", 400
+
+    manifest = other_files["rollout.json"].read().decode('utf-8')
+    if not util.find_signer(signature, manifest):
+        print("Bad signature!")
+        return "Invalid or unknown signature", 401
+
+    try:
+        req = RolloutRequest.model_validate(json.loads(manifest))
+    except (ValueError, ValidationError) as e:
+        print("Bad rollout manifest received")
+        return f"Bad rollout manifest: {e}", 400
+
+    # The same signed manifest always maps to the same rollout, so retries are harmless
+    secret_seed = bytes(signature)
+    rollout_id = hashlib.sha256(secret_seed).hexdigest()[:16]
+    existing = get_rollout(rollout_id)
+    if existing:
+        return jsonify(existing.status())
+
+    board_ids = select_boards(req)
+    unknown = [id for id in board_ids if id not in registry]
+    if unknown:
+        print(f"Rollout given for unknown board IDs: {unknown}")
+        return f"Unknown board IDs: {', '.join(unknown)}", 404
+    if not board_ids:
+        return "No boards selected", 404
+
+    if not util.available_firmware(util.FirmwareInfoRequest(firmware=req.firmware, version=req.version)):
+        print(f"Bad version: '{req.firmware}-{req.version}' was not found.")
+        return f"Bad version: '{req.firmware}-{req.version}' was not found.", 404
+
+    rollout = Rollout(rollout_id, req, board_ids, secret_seed)
+    # The boards are stored once, here - None unless it was sent to another worker at the same time
+    existing = state["storage"].add_rollout(rollout_id, rollout.to_dict(), board_ids)
+    if existing:
+        return jsonify(Rollout.from_dict(existing).status())
+    print(f"Rollout '{rollout_id}' of '{req.firmware}-{req.version}' to {len(board_ids)} boards")
+    rollout.release()
+
+    return jsonify(rollout.status())
+
+# Rollout progress - client API
+def status(id):
+    rollout = get_rollout(id)
+    if not rollout:
+        return f"Unknown rollout: {id}", 404
+    return jsonify(rollout.status())
@@ -0,0 +1,76 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Thread
+
+# Runs timed callbacks (like update order expiry) from a single thread,
+# using a min-heap of deadlines instead of one sleeping thread per timer.
+# Timers are identified by a key - scheduling a key again replaces its timer.
+class Scheduler():
+    def __init__(self):
+        self.heap: list[tuple[float, int, object]] = [] # (deadline, sequence number, key)
+        self.timers: dict[object, tuple[float, int, callable]] = {} # key -> live timer
+        self.sequence = itertools.count()
+        self.condition = Condition()
+        self.thread = None
+
+    # Calls callback() after delay seconds, unless cancelled first
+    def schedule(self, key, delay: float, callback):
+        deadline = time.monotonic() + delay
+        with self.condition:
+            if not self.thread:
+                self.start()
+            sequence = next(self.sequence)
+            self.timers[key] = (deadline, sequence, callback)
+            heapq.heappush(self.heap, (deadline, sequence, key))
+            # Wake the thread if this is the new earliest deadline
+            if self.heap[0][1] == sequence:
+                self.condition.notify()
+
+    # Cancelled timers are only dropped from the heap once they reach the top
+    # (or on compaction), so cancelling is O(1) and pushing/popping stays O(log n)
+    def cancel(self, key) -> bool:
+        with self.condition:
+            cancelled = self.timers.pop(key, None) is not None
+            if len(self.heap) > 64 and len(self.heap) > 2 * len(self.timers):
+                self.compact()
+            return cancelled
+
+    def compact(self):
+        self.heap = [(deadline, sequence, key) for key, (deadline, sequence, _) in self.timers.items()]
+        heapq.heapify(self.heap)
+
+    # Pops the next due timer, waiting for it if necessary
+    def next_due(self):
+        with self.condition:
+            while True:
+                if not self.heap:
+                    self.condition.wait()
+                    continue
+                deadline, sequence, key = self.heap[0]
+                timer = self.timers.get(key)
+                if not timer or timer[1] != sequence: # cancelled or replaced
+                    heapq.heappop(self.heap)
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self.condition.wait(timeout=remaining)
+                    continue
+                heapq.heappop(self.heap)
+                del self.timers[key]
+                return key, timer[2]
+
+    def run(self):
+        while True:
+            key, callback = self.next_due()
+            # callbacks run outside the lock, so they can schedule/cancel timers themselves
+            try:
+                callback()
+            except Exception as e:
+                print(f"Scheduled callback for '{key}' failed: {e}")
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+scheduler = Scheduler()
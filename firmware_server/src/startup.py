@@ -0,0 +1,39 @@
+import os
+
+import pgpy
+
+import fleet
+import heartbeat
+import history
+import registry
+import rollout
+import update
+from events import bus
+from util import state
+
+# Server configuration and state, set up once per process - shared by the Flask app
+# (app.py) and the ASGI app (asgi.py)
+def start():
+    # Defined in the Dockerfile
+    state["firmware_directory"] = os.environ["FIRMWARE_DIRECTORY"]
+    state["bundle_directory"] = os.environ["BUNDLE_DIRECTORY"]
+    os.makedirs(state["bundle_directory"], exist_ok=True)
+    # In lieu of a database for this simple example
+    key_path = os.path.join(state["firmware_directory"], 'keys', 'public.asc')
+    with open(key_path, 'r') as f:
+        key_block = f.read()
+    example_key, _ = pgpy.PGPKey.from_blob(key_block)
+    state["trusted_firmware_signers"] = {
+        "John Doe": example_key # ignore the fact that the name is included in the pubkey 
+    }
+    print(state["trusted_firmware_signers"])
+
+    registry.load_environment()
+
+    # Pick up where the server (or the other workers) left off
+    bus.start()
+    rollout.restore_rollouts()
+    update.rehydrate_orders()
+    history.start()
+    fleet.start()
+    heartbeat.start()
@@ -0,0 +1,664 @@
+import heapq
+import itertools
+import json
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Lock, local
+from typing import Optional
+
+from pydantic import BaseModel
+
+from orders import OrderExists, UpdateOrder
+
+# Where orders, their expirations, board records, rollouts, status history and the fleet's
+# counts are kept.
+# SQLiteStorage (the default, see STATE_DATABASE in the Dockerfile) survives restarts
+# and is shared by all worker processes; MemoryStorage is for running a single process
+# without a database file.
+
+# What the server knows about a board, apart from its orders
+class BoardRecord(BaseModel):
+    board_id: str
+    test: bool = False
+    site: Optional[str] = None
+    tags: list[str] = [] # groups that rollouts can select
+    firmware: Optional[str] = None # last firmware installed through an order
+    version: Optional[str] = None
+    updated: Optional[datetime] = None
+
+# A board's statuses over one window of time (see history.py), summed up.
+# Windows start at multiples of their length, so every process writing the same window
+# for a board adds to the same one.
+class StatusWindow(BaseModel):
+    board_id: str
+    started: float # unix time
+    ended: float # last status in the window
+    samples: int
+    firmware: str # as of the last status
+    version: str
+    uptime: int
+    boots: list[float] = [] # when the board booted (status time - uptime), per boot seen
+
+    # Adds another process' part of the same window
+    def merge(self, other: "StatusWindow"):
+        self.samples += other.samples
+        if other.ended > self.ended:
+            self.ended, self.firmware, self.version, self.uptime = \
+                    other.ended, other.firmware, other.version, other.uptime
+        self.boots = sorted(set(self.boots) | set(other.boots))
+
+# Versions reported by the boards in each bucket of time (from since on, bucket seconds
+# long), going by each board's last status in the bucket - as {bucket: {(firmware, version): boards}}
+def count_versions(windows: list[StatusWindow], since, bucket) -> dict[int, dict[tuple[str, str], int]]:
+    last: dict[tuple[int, str], StatusWindow] = {}
+    for window in windows:
+        key = (int((window.ended - since) // bucket), window.board_id)
+        if key not in last or window.ended > last[key].ended:
+            last[key] = window
+    counts = {}
+    for (index, _), window in last.items():
+        versions = counts.setdefault(index, {})
+        versions[(window.firmware, window.version)] = versions.get((window.firmware, window.version), 0) + 1
+    return counts
+
+# When a board was last heard from, what it runs, and when it counts as offline
+class BoardSeen(BaseModel):
+    board_id: str
+    firmware: str
+    version: str
+    last_seen: float # unix time
+    interval: float # seconds between its statuses, smoothed
+    deadline: float # offline if not heard from again by then
+    online: bool = True
+
+# A board's polling interval, as measured from one more status - gaps while it was offline don't count
+def next_interval(seen: BoardSeen, when) -> float:
+    if seen.online and when - seen.last_seen >= 1:
+        return (3 * seen.interval + when - seen.last_seen) / 4
+    return seen.interval
+
+class MemoryStorage():
+    shared = False # only one process can use it, so there is no one to send events to
+
+    def __init__(self):
+        self.orders: dict[str, UpdateOrder] = {}
+        self.boards: dict[str, BoardRecord] = {}
+        self.rollouts: dict[str, dict] = {}
+        self.rollout_board_ids: dict[str, list[str]] = {}
+        self.windows: dict[tuple[str, float], StatusWindow] = {}
+        self.seen: dict[str, BoardSeen] = {}
+        self.deadlines: list[tuple[float, str]] = [] # min-heap, with entries left behind by later statuses
+        self.counts: dict[str, dict[str, int]] = { "version": {}, "liveness": {} }
+        self.heartbeats: dict[str, int] = {}
+        self.generations = itertools.count(1)
+        self.lock = Lock()
+
+    def get_order(self, board_id) -> None | UpdateOrder:
+        return self.orders.get(board_id)
+
+    def get_orders(self, board_ids: list[str]) -> dict[str, UpdateOrder]:
+        orders = self.orders
+        return { board_id: orders[board_id] for board_id in board_ids if board_id in orders }
+
+    def count_orders(self) -> int:
+        return len(self.orders)
+
+    # Orders by expiration, soonest first
+    def pending_orders(self) -> list[UpdateOrder]:
+        with self.lock:
+            return sorted(self.orders.values(), key=lambda order: order.expiration)
+
+    # Stores the order under a new generation, returns the order it replaced, if any
+    def put_order(self, order: UpdateOrder, overwrite=False) -> None | UpdateOrder:
+        with self.lock:
+            previous = self.orders.get(order.board_id)
+            if previous and not overwrite:
+                raise OrderExists(order.board_id)
+            order.generation = next(self.generations)
+            self.orders[order.board_id] = order
+        return previous
+
+    # Removes the order if it is still the given generation (any, if None), returns it
+    def remove_order(self, board_id, generation) -> None | UpdateOrder:
+        with self.lock:
+            order = self.orders.get(board_id)
+            if not order or (generation is not None and order.generation != generation):
+                return None
+            del self.orders[board_id]
+        return order
+
+    def get_board(self, board_id) -> None | BoardRecord:
+        return self.boards.get(board_id)
+
+    def load_boards(self) -> list[BoardRecord]:
+        with self.lock:
+            return [board.model_copy() for board in self.boards.values()]
+
+    # Adds or updates the boards' registration (test, site and tags), keeping the rest
+    def import_boards(self, boards: list[BoardRecord]):
+        with self.lock:
+            for board in boards:
+                stored = self.boards.setdefault(board.board_id, BoardRecord(board_id=board.board_id))
+                stored.test, stored.site, stored.tags = board.test, board.site, list(board.tags)
+
+    def set_board_firmware(self, board_id, firmware, version):
+        with self.lock:
+            board = self.boards.setdefault(board_id, BoardRecord(board_id=board_id))
+            board.firmware, board.version, board.updated = firmware, version, datetime.now()
+
+    # Stores a new rollout and its boards, returns the stored rollout instead if there is one
+    def add_rollout(self, rollout_id, data: dict, board_ids: list[str]) -> None | dict:
+        with self.lock:
+            if rollout_id in self.rollouts:
+                return self.rollouts[rollout_id]
+            self.rollouts[rollout_id] = data
+            self.rollout_board_ids[rollout_id] = list(board_ids)
+        return None
+
+    # Yields {"data": the stored rollout}, and stores whatever data is left in it
+    @contextmanager
+    def rollout_transaction(self, rollout_id):
+        with self.lock:
+            stored = { "data": self.rollouts.get(rollout_id) }
+            yield stored
+            if stored["data"] is not None:
+                self.rollouts[rollout_id] = stored["data"]
+
+    # count of the rollout's boards, from the start-th on
+    def rollout_boards(self, rollout_id, start, count) -> list[str]:
+        return self.rollout_board_ids[rollout_id][start:start + count]
+
+    def get_rollout(self, rollout_id) -> None | dict:
+        return self.rollouts.get(rollout_id)
+
+    def load_rollouts(self) -> list[dict]:
+        return list(self.rollouts.values())
+
+    def save_windows(self, windows: list[StatusWindow]):
+        with self.lock:
+            for window in windows:
+                stored = self.windows.get((window.board_id, window.started))
+                if stored:
+                    stored.merge(window)
+                else:
+                    self.windows[(window.board_id, window.started)] = window.model_copy()
+
+    # The board's windows that ended at or after since, oldest first
+    def load_windows(self, board_id, since) -> list[StatusWindow]:
+        with self.lock:
+            return sorted((window.model_copy() for window in self.windows.values()
+                           if window.board_id == board_id and window.ended >= since),
+                          key=lambda window: window.started)
+
+    def last_window(self, board_id) -> None | StatusWindow:
+        windows = self.load_windows(board_id, 0)
+        return max(windows, key=lambda window: window.ended) if windows else None
+
+    def version_counts(self, since, bucket) -> dict[int, dict[tuple[str, str], int]]:
+        with self.lock:
+            windows = [window for window in self.windows.values() if window.ended >= since]
+        return count_versions(windows, since, bucket)
+
+    def prune_windows(self, before):
+        with self.lock:
+            self.windows = { key: window for key, window in self.windows.items() if window.ended >= before }
+
+    def count(self, kind, key, change):
+        counts = self.counts[kind]
+        counts[key] = counts.get(key, 0) + change
+
+    # (board id, firmware, version, time, seconds until its next status) of statuses - older
+    # than what is stored are skipped. A board is offline once it missed the given number of
+    # its polls, going by the longer of its measured interval (a guess until measured) and
+    # the one it was told. Returns the ids of the boards that were offline.
+    def save_seen(self, statuses: list[tuple[str, str, str, float, float]], missed, interval) -> list[str]:
+        back = []
+        with self.lock:
+            for board_id, firmware, version, when, expected in statuses:
+                seen = self.seen.get(board_id)
+                if seen is None:
+                    seen = self.seen[board_id] = BoardSeen(board_id=board_id, firmware=firmware, version=version,
+                                                           last_seen=when, interval=interval, deadline=0)
+                    self.count("version", f"{firmware}-{version}", 1)
+                    self.count("liveness", "online", 1)
+                elif when < seen.last_seen:
+                    continue
+                else:
+                    if (seen.firmware, seen.version) != (firmware, version):
+                        self.count("version", f"{seen.firmware}-{seen.version}", -1)
+                        self.count("version", f"{firmware}-{version}", 1)
+                    seen.interval = next_interval(seen, when)
+                    if not seen.online:
+                        self.count("liveness", "offline", -1)
+                        self.count("liveness", "online", 1)
+                        back.append(board_id)
+                seen.firmware, seen.version, seen.last_seen, seen.online = firmware, version, when, True
+                seen.deadline = when + missed * max(seen.interval, expected)
+                heapq.heappush(self.deadlines, (seen.deadline, board_id))
+        return back
+
+    # Marks the online boards past their deadline offline, returns them
+    def mark_offline(self, now) -> list[BoardSeen]:
+        offline = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] < now:
+                deadline, board_id = heapq.heappop(self.deadlines)
+                seen = self.seen[board_id]
+                if seen.online and seen.deadline == deadline: # not seen again since
+                    seen.online = False
+                    self.count("liveness", "online", -1)
+                    self.count("liveness", "offline", 1)
+                    offline.append(seen.model_copy())
+        return offline
+
+    # Offline boards, longest overdue first
+    def offline_boards(self, limit) -> list[BoardSeen]:
+        with self.lock:
+            offline = sorted((seen for seen in self.seen.values() if not seen.online), key=lambda seen: seen.deadline)
+            return [seen.model_copy() for seen in offline[:limit]]
+
+    def fleet_counts(self) -> dict[str, dict[str, int]]:
+        with self.lock:
+            return { kind: { key: value for key, value in counts.items() if value > 0 }
+                     for kind, counts in self.counts.items() }
+
+    # Records a heartbeat's counter, if it is past the last one accepted for the board -
+    # False for a replay
+    def accept_heartbeat(self, board_id, counter) -> bool:
+        with self.lock:
+            if counter <= self.heartbeats.get(board_id, 0):
+                return False
+            self.heartbeats[board_id] = counter
+            return True
+
+    # Only one process uses it, so it always holds every lease
+    def claim_lease(self, name, owner, duration) -> bool:
+        return True
+
+# Statements are fixed strings with ? parameters, so sqlite3's per-connection
+# statement cache prepares each of them only once
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS orders (
+    board_id TEXT PRIMARY KEY,
+    firmware TEXT NOT NULL,
+    version TEXT NOT NULL,
+    secret TEXT NOT NULL,
+    expiration REAL NOT NULL,
+    generation INTEGER NOT NULL,
+    rollout TEXT
+);
+CREATE INDEX IF NOT EXISTS orders_expiration ON orders (expiration);
+CREATE TABLE IF NOT EXISTS boards (
+    board_id TEXT PRIMARY KEY,
+    test INTEGER NOT NULL DEFAULT 0,
+    site TEXT,
+    tags TEXT NOT NULL DEFAULT '[]',
+    firmware TEXT,
+    version TEXT,
+    updated REAL
+);
+-- data is the rollout's progress, rewritten as it goes, boards its JSON array of board ids,
+-- written once
+CREATE TABLE IF NOT EXISTS rollouts (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    boards TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    data TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS status_windows (
+    board_id TEXT NOT NULL,
+    started REAL NOT NULL,
+    ended REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    firmware TEXT NOT NULL,
+    version TEXT NOT NULL,
+    uptime INTEGER NOT NULL,
+    boots TEXT NOT NULL DEFAULT '[]',
+    PRIMARY KEY (board_id, started)
+);
+CREATE INDEX IF NOT EXISTS status_windows_ended ON status_windows (ended);
+CREATE TABLE IF NOT EXISTS board_seen (
+    board_id TEXT PRIMARY KEY,
+    firmware TEXT NOT NULL,
+    version TEXT NOT NULL,
+    last_seen REAL NOT NULL,
+    interval REAL NOT NULL,
+    deadline REAL NOT NULL,
+    online INTEGER NOT NULL DEFAULT 1
+);
+-- Boards ordered by when they go offline, so finding the ones that did is a range scan
+CREATE INDEX IF NOT EXISTS board_seen_deadline ON board_seen (online, deadline);
+-- Boards per firmware version and liveness ('online'/'offline'), kept up to date by
+-- the triggers below whenever a board's row changes, so reading them is never a scan
+CREATE TABLE IF NOT EXISTS fleet_counts (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+CREATE TRIGGER IF NOT EXISTS board_seen_added AFTER INSERT ON board_seen BEGIN
+    INSERT INTO fleet_counts VALUES ('version', new.firmware || '-' || new.version, 1)
+        ON CONFLICT DO UPDATE SET value = value + 1;
+    INSERT INTO fleet_counts VALUES ('liveness', iif(new.online, 'online', 'offline'), 1)
+        ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS board_seen_version AFTER UPDATE OF firmware, version ON board_seen
+WHEN old.firmware != new.firmware OR old.version != new.version BEGIN
+    UPDATE fleet_counts SET value = value - 1 WHERE kind = 'version' AND key = old.firmware || '-' || old.version;
+    INSERT INTO fleet_counts VALUES ('version', new.firmware || '-' || new.version, 1)
+        ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS board_seen_liveness AFTER UPDATE OF online ON board_seen
+WHEN old.online != new.online BEGIN
+    UPDATE fleet_counts SET value = value - 1 WHERE kind = 'liveness' AND key = iif(old.online, 'online', 'offline');
+    INSERT INTO fleet_counts VALUES ('liveness', iif(new.online, 'online', 'offline'), 1)
+        ON CONFLICT DO UPDATE SET value = value + 1;
+END;
+-- The last heartbeat counter accepted from each board, so a replay is dropped by every process
+CREATE TABLE IF NOT EXISTS heartbeat_counters (
+    board_id TEXT PRIMARY KEY,
+    counter INTEGER NOT NULL
+);
+-- Jobs only one process should run at a time (like the offline sweep), each held by
+-- the process that claimed it until it expires
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO counters (name, value) VALUES ('generation', 0);
+"""
+
+ORDER_COLUMNS = "board_id, firmware, version, secret, expiration, generation, rollout"
+SELECT_ORDER = f"SELECT {ORDER_COLUMNS} FROM orders WHERE board_id = ?"
+# all ids go in as one JSON array, so it's the same statement for any number of them
+SELECT_ORDERS = f"SELECT {ORDER_COLUMNS} FROM orders WHERE board_id IN (SELECT value FROM json_each(?))"
+SELECT_PENDING_ORDERS = f"SELECT {ORDER_COLUMNS} FROM orders ORDER BY expiration"
+COUNT_ORDERS = "SELECT count(*) FROM orders"
+NEXT_GENERATION = "UPDATE counters SET value = value + 1 WHERE name = 'generation' RETURNING value"
+INSERT_ORDER = f"INSERT OR REPLACE INTO orders ({ORDER_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+DELETE_ORDER = f"DELETE FROM orders WHERE board_id = ?1 AND (?2 IS NULL OR generation = ?2) RETURNING {ORDER_COLUMNS}"
+BOARD_COLUMNS = "board_id, test, site, tags, firmware, version, updated"
+SELECT_BOARD = f"SELECT {BOARD_COLUMNS} FROM boards WHERE board_id = ?"
+SELECT_BOARDS = f"SELECT {BOARD_COLUMNS} FROM boards"
+IMPORT_BOARD = """INSERT INTO boards (board_id, test, site, tags) VALUES (?, ?, ?, ?)
+    ON CONFLICT (board_id) DO UPDATE SET test = excluded.test, site = excluded.site, tags = excluded.tags"""
+SET_BOARD_FIRMWARE = """INSERT INTO boards (board_id, firmware, version, updated) VALUES (?, ?, ?, ?)
+    ON CONFLICT (board_id) DO UPDATE SET firmware = excluded.firmware, version = excluded.version, updated = excluded.updated"""
+INSERT_ROLLOUT = "INSERT INTO rollouts (id, data, boards) VALUES (?, ?, ?) ON CONFLICT (id) DO NOTHING"
+SAVE_ROLLOUT = "UPDATE rollouts SET data = ? WHERE id = ?"
+SELECT_ROLLOUT_BOARDS = "SELECT board.value FROM rollouts, json_each(rollouts.boards) AS board WHERE rollouts.id = ? ORDER BY board.key LIMIT ? OFFSET ?"
+SELECT_ROLLOUT = "SELECT data FROM rollouts WHERE id = ?"
+SELECT_ROLLOUTS = "SELECT data FROM rollouts"
+INSERT_EVENT = "INSERT INTO events (origin, kind, data, created) VALUES (?, ?, ?, ?)"
+SELECT_EVENTS = "SELECT id, kind, data FROM events WHERE id > ? AND origin != ? ORDER BY id"
+LAST_EVENT = "SELECT coalesce(max(id), 0) FROM events"
+PRUNE_EVENTS = "DELETE FROM events WHERE created < ?"
+WINDOW_COLUMNS = "board_id, started, ended, samples, firmware, version, uptime, boots"
+# the same as StatusWindow.merge - all of SET sees the stored row as it was
+SAVE_WINDOW = f"""INSERT INTO status_windows ({WINDOW_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (board_id, started) DO UPDATE SET
+        samples = samples + excluded.samples,
+        ended = max(ended, excluded.ended),
+        firmware = iif(excluded.ended > ended, excluded.firmware, firmware),
+        version = iif(excluded.ended > ended, excluded.version, version),
+        uptime = iif(excluded.ended > ended, excluded.uptime, uptime),
+        boots = (SELECT json_group_array(value) FROM (SELECT value FROM json_each(boots)
+                 UNION SELECT value FROM json_each(excluded.boots)))"""
+SELECT_WINDOWS = f"SELECT {WINDOW_COLUMNS} FROM status_windows WHERE board_id = ? AND ended >= ? ORDER BY started"
+SELECT_LAST_WINDOW = f"SELECT {WINDOW_COLUMNS} FROM status_windows WHERE board_id = ? ORDER BY ended DESC LIMIT 1"
+# each board's last window in every bucket (SQLite takes the bare columns from the max() row)
+COUNT_VERSIONS = """SELECT bucket, firmware, version, count(*) FROM (
+        SELECT CAST((ended - ?1) / ?2 AS INTEGER) AS bucket, firmware, version, max(ended)
+        FROM status_windows WHERE ended >= ?1 GROUP BY board_id, bucket)
+    GROUP BY bucket, firmware, version"""
+PRUNE_WINDOWS = "DELETE FROM status_windows WHERE ended < ?"
+SEEN_COLUMNS = "board_id, firmware, version, last_seen, interval, deadline, online"
+# the same as next_interval
+NEXT_INTERVAL = """iif(online AND excluded.last_seen - last_seen >= 1,
+                       (3 * interval + excluded.last_seen - last_seen) / 4, interval)"""
+# a status older than the stored one (from a process that flushed late) changes nothing
+SAVE_SEEN = f"""INSERT INTO board_seen ({SEEN_COLUMNS}) VALUES (?1, ?2, ?3, ?4, ?7, ?4 + ?6 * max(?7, ?5), 1)
+    ON CONFLICT (board_id) DO UPDATE SET firmware = excluded.firmware, version = excluded.version,
+        last_seen = excluded.last_seen, interval = {NEXT_INTERVAL},
+        deadline = excluded.last_seen + ?6 * max({NEXT_INTERVAL}, ?5), online = 1
+    WHERE excluded.last_seen >= last_seen"""
+SELECT_OFFLINE_AMONG = "SELECT board_id FROM board_seen WHERE online = 0 AND board_id IN (SELECT value FROM json_each(?))"
+MARK_OFFLINE = f"UPDATE board_seen SET online = 0 WHERE online = 1 AND deadline < ? RETURNING {SEEN_COLUMNS}"
+SELECT_OFFLINE = f"SELECT {SEEN_COLUMNS} FROM board_seen WHERE online = 0 ORDER BY deadline LIMIT ?"
+SELECT_FLEET_COUNTS = "SELECT kind, key, value FROM fleet_counts WHERE value > 0"
+# changes nothing (and so no row is returned) unless the counter moved forward
+ACCEPT_HEARTBEAT = """INSERT INTO heartbeat_counters (board_id, counter) VALUES (?1, ?2)
+    ON CONFLICT (board_id) DO UPDATE SET counter = excluded.counter WHERE excluded.counter > counter
+    RETURNING counter"""
+SELECT_LEASE = "SELECT owner, expires FROM leases WHERE name = ?"
+# changes nothing (and so no row is returned) while another owner's lease hasn't expired
+CLAIM_LEASE = """INSERT INTO leases (name, owner, expires) VALUES (?1, ?2, ?3 + ?4)
+    ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires
+    WHERE owner = excluded.owner OR expires < ?3
+    RETURNING owner"""
+
+class SQLiteStorage():
+    shared = True # between all processes using the same database file
+
+    def __init__(self, path):
+        self.path = path
+        self.local = local() # sqlite3 connections can't be shared between threads
+        db = self.connection()
+        db.executescript(SCHEMA)
+
+    def connection(self) -> sqlite3.Connection:
+        db = getattr(self.local, "db", None)
+        if db is None:
+            # autocommit - multi-statement changes use explicit transactions
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL") # readers don't block the writer
+            db.execute("PRAGMA synchronous=NORMAL") # durable enough with WAL, much faster
+            self.local.db = db
+        return db
+
+    def order_from_row(self, row) -> UpdateOrder:
+        board_id, firmware, version, secret, expiration, generation, rollout = row
+        # model_validate skips UpdateOrder.__init__, which would reset the expiration
+        return UpdateOrder.model_validate({
+            "board_id": board_id, "firmware": firmware, "version": version, "secret": secret,
+            "expiration": datetime.fromtimestamp(expiration), "generation": generation,
+            "rollout": rollout,
+        })
+
+    def get_order(self, board_id) -> None | UpdateOrder:
+        row = self.connection().execute(SELECT_ORDER, (board_id,)).fetchone()
+        return self.order_from_row(row) if row else None
+
+    def get_orders(self, board_ids: list[str]) -> dict[str, UpdateOrder]:
+        rows = self.connection().execute(SELECT_ORDERS, (json.dumps(board_ids),))
+        return { row[0]: self.order_from_row(row) for row in rows }
+
+    def count_orders(self) -> int:
+        return self.connection().execute(COUNT_ORDERS).fetchone()[0]
+
+    def pending_orders(self) -> list[UpdateOrder]:
+        return [self.order_from_row(row) for row in self.connection().execute(SELECT_PENDING_ORDERS)]
+
+    # Takes the write lock up front, so whatever is read inside still holds when writing -
+    # other processes wait (up to the connection timeout) instead of failing
+    @contextmanager
+    def transaction(self):
+        db = self.connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except:
+            db.execute("ROLLBACK")
+            raise
+
+    def put_order(self, order: UpdateOrder, overwrite=False) -> None | UpdateOrder:
+        with self.transaction() as db:
+            row = db.execute(SELECT_ORDER, (order.board_id,)).fetchone()
+            if row and not overwrite:
+                raise OrderExists(order.board_id)
+            generation = db.execute(NEXT_GENERATION).fetchone()[0]
+            db.execute(INSERT_ORDER, (order.board_id, order.firmware, order.version, order.secret,
+                                      order.expiration.timestamp(), generation, order.rollout))
+        order.generation = generation
+        return self.order_from_row(row) if row else None
+
+    # A single conditional DELETE, so when several processes try to end the same order
+    # (say, one expiring it while another completes it) exactly one of them gets it
+    def remove_order(self, board_id, generation) -> None | UpdateOrder:
+        row = self.connection().execute(DELETE_ORDER, (board_id, generation)).fetchone()
+        return self.order_from_row(row) if row else None
+
+    def board_from_row(self, row) -> BoardRecord:
+        board_id, test, site, tags, firmware, version, updated = row
+        return BoardRecord(board_id=board_id, test=bool(test), site=site, tags=json.loads(tags),
+                           firmware=firmware, version=version,
+                           updated=datetime.fromtimestamp(updated) if updated else None)
+
+    def get_board(self, board_id) -> None | BoardRecord:
+        row = self.connection().execute(SELECT_BOARD, (board_id,)).fetchone()
+        return self.board_from_row(row) if row else None
+
+    def load_boards(self) -> list[BoardRecord]:
+        return [self.board_from_row(row) for row in self.connection().execute(SELECT_BOARDS)]
+
+    def import_boards(self, boards: list[BoardRecord]):
+        with self.transaction() as db: # one transaction for all of them
+            db.executemany(IMPORT_BOARD, [(board.board_id, int(board.test), board.site,
+                                           json.dumps(board.tags)) for board in boards])
+
+    def set_board_firmware(self, board_id, firmware, version):
+        self.connection().execute(SET_BOARD_FIRMWARE, (board_id, firmware, version,
+                                                       datetime.now().timestamp()))
+
+    def add_rollout(self, rollout_id, data: dict, board_ids: list[str]) -> None | dict:
+        with self.transaction() as db:
+            if db.execute(INSERT_ROLLOUT, (rollout_id, json.dumps(data), json.dumps(board_ids))).rowcount:
+                return None
+            return json.loads(db.execute(SELECT_ROLLOUT, (rollout_id,)).fetchone()[0])
+
+    # Only the progress is written back - the boards stay as they were stored
+    @contextmanager
+    def rollout_transaction(self, rollout_id):
+        with self.transaction() as db:
+            row = db.execute(SELECT_ROLLOUT, (rollout_id,)).fetchone()
+            stored = { "data": json.loads(row[0]) if row else None }
+            yield stored
+            if stored["data"] is not None:
+                db.execute(SAVE_ROLLOUT, (json.dumps(stored["data"]), rollout_id))
+
+    def rollout_boards(self, rollout_id, start, count) -> list[str]:
+        rows = self.connection().execute(SELECT_ROLLOUT_BOARDS, (rollout_id, count, start))
+        return [board_id for board_id, in rows]
+
+    def get_rollout(self, rollout_id) -> None | dict:
+        row = self.connection().execute(SELECT_ROLLOUT, (rollout_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def load_rollouts(self) -> list[dict]:
+        return [json.loads(data) for data, in self.connection().execute(SELECT_ROLLOUTS)]
+
+    # Events are how processes tell each other about orders - see events.py
+    def append_event(self, origin, kind, data: dict):
+        self.connection().execute(INSERT_EVENT, (origin, kind, json.dumps(data), time.time()))
+
+    # Events from other processes since the given event id, as (id, kind, data)
+    def events_after(self, event_id, origin) -> list[tuple[int, str, dict]]:
+        rows = self.connection().execute(SELECT_EVENTS, (event_id, origin)).fetchall()
+        return [(id, kind, json.loads(data)) for id, kind, data in rows]
+
+    def last_event_id(self) -> int:
+        return self.connection().execute(LAST_EVENT).fetchone()[0]
+
+    def prune_events(self, max_age: float):
+        self.connection().execute(PRUNE_EVENTS, (time.time() - max_age,))
+
+    def window_from_row(self, row) -> StatusWindow:
+        board_id, started, ended, samples, firmware, version, uptime, boots = row
+        return StatusWindow(board_id=board_id, started=started, ended=ended, samples=samples,
+                            firmware=firmware, version=version, uptime=uptime, boots=json.loads(boots))
+
+    def save_windows(self, windows: list[StatusWindow]):
+        with self.transaction() as db:
+            db.executemany(SAVE_WINDOW, [(window.board_id, window.started, window.ended, window.samples,
+                                          window.firmware, window.version, window.uptime,
+                                          json.dumps(window.boots)) for window in windows])
+
+    def load_windows(self, board_id, since) -> list[StatusWindow]:
+        return [self.window_from_row(row) for row in self.connection().execute(SELECT_WINDOWS, (board_id, since))]
+
+    def last_window(self, board_id) -> None | StatusWindow:
+        row = self.connection().execute(SELECT_LAST_WINDOW, (board_id,)).fetchone()
+        return self.window_from_row(row) if row else None
+
+    def version_counts(self, since, bucket) -> dict[int, dict[tuple[str, str], int]]:
+        counts = {}
+        for index, firmware, version, boards in self.connection().execute(COUNT_VERSIONS, (since, bucket)):
+            counts.setdefault(index, {})[(firmware, version)] = boards
+        return counts
+
+    def prune_windows(self, before):
+        self.connection().execute(PRUNE_WINDOWS, (before,))
+
+    def seen_from_row(self, row) -> BoardSeen:
+        board_id, firmware, version, last_seen, interval, deadline, online = row
+        return BoardSeen(board_id=board_id, firmware=firmware, version=version, last_seen=last_seen,
+                         interval=interval, deadline=deadline, online=bool(online))
+
+    def save_seen(self, statuses: list[tuple[str, str, str, float, float]], missed, interval) -> list[str]:
+        with self.transaction() as db:
+            ids = json.dumps([status[0] for status in statuses])
+            back = [board_id for board_id, in db.execute(SELECT_OFFLINE_AMONG, (ids,))]
+            db.executemany(SAVE_SEEN, [(*status, missed, interval) for status in statuses])
+        return back
+
+    # A single UPDATE, so it needs no transaction of its own
+    def mark_offline(self, now) -> list[BoardSeen]:
+        rows = self.connection().execute(MARK_OFFLINE, (now,)).fetchall()
+        return [self.seen_from_row(row) for row in rows]
+
+    def offline_boards(self, limit) -> list[BoardSeen]:
+        return [self.seen_from_row(row) for row in self.connection().execute(SELECT_OFFLINE, (limit,))]
+
+    def fleet_counts(self) -> dict[str, dict[str, int]]:
+        counts = { "version": {}, "liveness": {} }
+        for kind, key, value in self.connection().execute(SELECT_FLEET_COUNTS):
+            counts[kind][key] = value
+        return counts
+
+    def accept_heartbeat(self, board_id, counter) -> bool:
+        return self.connection().execute(ACCEPT_HEARTBEAT, (board_id, counter)).fetchone() is not None
+
+    # True if owner holds the lease (for duration seconds). Only reads while another owner
+    # holds it, or while the owner's own lease is good for more than half of it.
+    def claim_lease(self, name, owner, duration) -> bool:
+        db = self.connection()
+        now = time.time()
+        row = db.execute(SELECT_LEASE, (name,)).fetchone()
+        if row:
+            holder, expires = row
+            if holder != owner and expires >= now:
+                return False
+            if holder == owner and expires - now > duration / 2:
+                return True
+        return db.execute(CLAIM_LEASE, (name, owner, now, duration)).fetchone() is not None
+
+# An empty path keeps everything in memory
+def open_storage(path):
+    if not path:
+        print("No STATE_DATABASE set, orders are kept in memory only")
+        return MemoryStorage()
+    return SQLiteStorage(path)
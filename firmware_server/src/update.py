@@ -1,86 +1,76 @@
 import hashlib
-import io
+import json
 import os
-import tarfile
-import time
-from datetime import datetime, timedelta
-from threading import Event, Thread
-
-from flask import json, request, send_file
-from pydantic import BaseModel, ValidationError
-
+from datetime import datetime
+from threading import Lock
+
+from flask import Response, request, send_file
+from pydantic import BaseModel, TypeAdapter, ValidationError
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import FileWrapper
+
+import bundle
+import cbor
+import polling
 import util
+from admission import downloads
+from events import bus
+from fleet import fleet
+from history import history
+from orders import UpdateOrder
+from registry import registry
+from scheduler import scheduler
 from util import state
 
-time_to_expiry = timedelta(minutes=int(os.environ["UPDATE_EXPIRACY_MINUTES"]))
-
-# Info for update orders - terminated by expiration or completion
-# Stored in state["orders"] as a dict with the board_id for one order/board at a time
-class UpdateOrder(BaseModel):
-    board_id: str
-    firmware: str
-    version: str
-    secret: str
-    expiration: datetime = datetime.now()
-
-    # Automatic expiration creation
-    def __init__(self, **data):
-        super().__init__(**data)
-        self.expiration = datetime.now() + time_to_expiry;
-
-# SHOULD ONLY BE USED BY CLEANUP THREAD - activate through setting the event
-def remove_order(board_id):
-    result = True if state["orders"].pop(board_id, None) else False
-    if not result:
-        print("Tried to remove Update Order which no longer exists")
-    state["cleanup_events"].pop(board_id, None)
-    return result
-
-# Thread to remove update order on expiry or success
-# Since one thread only touches a single and unique key in the state dict,
-# race conditions should not happen
-class CleanupThread():
-    board_id: str
-    cleanup_event: Event
-    sleep_time: float
-
-    def __init__(self, order: UpdateOrder, cleanup_event: Event):
-        self.board_id = order.board_id
-        self.cleanup_event = cleanup_event
-        self.sleep_time = (order.expiration - datetime.now()).total_seconds()
-
-    def run(self) -> None:
-        assert self.cleanup_event
-        success = self.cleanup_event.wait(timeout=self.sleep_time)
-        message = "installed successfully" if success else "timed out"
-        print(f"Update {message} on board '{self.board_id}'")
-        remove_order(self.board_id)
-
-    # Start the thread
-    def start(self):
-        state["cleanup_events"][self.board_id] = self.cleanup_event
-        thread = Thread(target=self.run, daemon=True)
-        thread.start()
+# Run by the scheduler when an order's expiration is reached - a no-op if the order
+# was completed or replaced in the meantime
+def expire_order(board_id, generation):
+    if state["orders"].expire(board_id, generation):
+        print(f"Update timed out on board '{board_id}'")
 
 def add_order(order: UpdateOrder, overwrite=False):
-    cleanup_event = Event()
-    thread = CleanupThread(order, cleanup_event)
-
-    if order.board_id in state["orders"] and not overwrite:
-        raise Exception(f"Update Order already exists for '{order.board_id}'!\nUse PUT to overwrite.")
-    elif overwrite:
-        # Shut down the previous thread before starting this one to avoid races
-        # This currently acts the same as order_complete
-        state["cleanup_events"][order.board_id].set()
-        time.sleep(1)
-
-    state["orders"][order.board_id] = order
-    state["cleanup_events"][order.board_id] = cleanup_event
-
-    thread.start()
-
-def order_complete(board_id):
-    state["cleanup_events"][board_id].set()
+    # raises OrderExists if there is an order and overwrite isn't set
+    previous = state["orders"].add(order, overwrite)
+    if previous:
+        print(f"Update order for board '{order.board_id}' replaced")
+    bus.publish("order_added", order.model_dump(mode="json"))
+
+# One shared scheduler thread (per process) handles the expiry of all orders.
+# Every process schedules every order, so orders still expire if the process that
+# placed them goes away - only one of them gets to actually expire it.
+def schedule_expiry(order: UpdateOrder):
+    time_left = (order.expiration - datetime.now()).total_seconds()
+    scheduler.schedule(("order", order.board_id, order.generation), time_left,
+                       lambda: expire_order(order.board_id, order.generation))
+
+# generation=None completes whatever order the board has
+def order_complete(board_id, generation=None):
+    order = state["orders"].complete(board_id, generation)
+    if not order:
+        print("Tried to remove Update Order which no longer exists")
+        return
+    state["storage"].set_board_firmware(board_id, order.firmware, order.version)
+    fleet.seen(board_id, order.firmware, order.version) # about to reboot into it
+    print(f"Update installed successfully on board '{board_id}'")
+
+# Orders ending in any process (completed, expired or replaced) cancel their expiry everywhere
+def publish_finished(order: UpdateOrder, outcome):
+    bus.publish("order_finished", { "board_id": order.board_id, "generation": order.generation,
+                                    "outcome": outcome })
+
+state["orders"].on_finished(publish_finished)
+bus.subscribe("order_added", lambda data: schedule_expiry(UpdateOrder.model_validate(data)))
+bus.subscribe("order_finished", lambda data: scheduler.cancel(("order", data["board_id"], data["generation"])))
+
+# Puts the expiry of stored orders (placed before a restart, or by other workers before
+# this one started) on the scheduler - orders that expired in the meantime expire right away
+def rehydrate_orders():
+    orders = state["orders"].pending()
+    for order in orders:
+        schedule_expiry(order)
+    if orders:
+        print(f"Restored {len(orders)} pending update orders")
 
 class OrderRequest(BaseModel): 
     firmware: str
@@ -122,11 +112,11 @@ def order(id):
         return "Invalid or unknown signature", 401
     
     # check for known ids
-    if not order.board_id in state["known_ids"] + state["known_test_ids"]:
+    if not order.board_id in registry:
         print(f"Order given for unknown board ID: {order.board_id}")
         return f"Unknown board ID: {order.board_id}", 404
 
-    is_test = order.board_id in state["known_test_ids"]
+    is_test = registry.is_test(order.board_id)
     if is_test:
         print("Test ID detected. Remember to deal with test ID's before production deployment")
 
@@ -160,14 +150,6 @@ def order(id):
 
     return secret
 
-def calculate_shasum(file_path):
-    sha = hashlib.sha256()
-    with open(file_path, 'rb') as f:
-        for block in iter(lambda: f.read(4096), b''):
-            print(f"Block (len {len(block)}): {block}")
-            sha.update(block)
-    return sha.hexdigest()
-
 class Respond(Exception):
     def __init__(self, message, status_code):
         super().__init__(message)
@@ -182,6 +164,7 @@ class BoardUpdateRequest(BaseModel):
     version: str
     board_id: str
     secret: str
+    delta: bool = False # board can apply delta bundles
 
     def check_request_get_order(self, id, testing, request_type):
         if id != self.board_id:
@@ -189,17 +172,16 @@ class BoardUpdateRequest(BaseModel):
             raise Respond("Mismatch in URL id and reported board id", 400)
         
         # check if ID is known
-        if not self.board_id in state["known_ids"] and not self.board_id in state["known_test_ids"]:
+        if not self.board_id in registry:
             print(f"{request_type.capitalize()} request received from unknown ID: {self.board_id}")
             raise Respond(f"Unknown ID: {self.board_id}", 401)
     
         # check if id has an update order pending
         test_pass = self.board_id == "-2"
-        if self.board_id not in state["orders"] and not test_pass:
+        order = state["orders"].get(self.board_id) # Should have used a real test suite
+        if not order and not test_pass:
             print(f"Known board '{self.board_id}'")
             raise Respond("You do not have an update order.", 406)
-
-        order = state["orders"][self.board_id] # Should have used a real test suite
     
         # check secret
         if self.secret != (order.secret if not testing else "test_secret"):
@@ -208,68 +190,312 @@ class BoardUpdateRequest(BaseModel):
 
         return order
 
-def download(id):
+# The board API without the web framework - used by the Flask routes here and in app.py,
+# and by the ASGI app (asgi.py). Each takes the request's JSON body as bytes (validated
+# straight from them, without building a dict first) or its parsed CBOR, and raises
+# Respond for anything but the normal answer.
+
+# None (a body that wasn't JSON or CBOR) fails validation like bad JSON does
+def validate_board_data(model, data: None | dict | bytes):
+    if isinstance(data, (bytes, type(None))):
+        return model.model_validate_json(data or b"", strict=False)
+    return model.model_validate(data, strict=False)
+
+def not_json(e: ValidationError) -> bool:
+    return any(error["type"] == "json_invalid" for error in e.errors())
+
+# Receiving status reports from Pi's
+class Status(BaseModel):
+    firmware: str
+    version: str
+    board_id: str
+    uptime: int
+
+# Every ping of every board - nothing is printed unless something is wrong
+def board_status(data: None | dict | bytes) -> dict:
     try:
-        dl_req = BoardUpdateRequest.model_validate(request.json, strict=False)
+        status = validate_board_data(Status, data)
     except ValidationError as e:
-        print(f"Badly formatted download request. {str(e)}")
-        return "Bad download request structure", 400
+        if not_json(e):
+            print("Status data was not JSON or CBOR")
+            raise Respond("Request must be JSON or CBOR", 400)
+        print("Status data is invalid")
+        raise Respond(f"JSON format is invalid: {e}", 400)
+
+    if not status.board_id in registry:
+        print(f"Status received from unknown ID: {status.board_id}")
+        raise Respond(f"Unknown ID: {status.board_id}", 401)
+
+    return handle_status(status)
+
+# A status from a registered board (over HTTP, or as a UDP heartbeat - see heartbeat.py)
+def handle_status(status: Status) -> dict:
+    polling.rate.add()
+    answer = status_answer(status, state["orders"].get(status.board_id))
+    record_status(status, answer["next_poll"])
+    return answer
+
+# Every status of a registered board goes into its history and the fleet's counts
+def record_status(status: Status, next_poll):
+    history.record(status.board_id, status.firmware, status.version, status.uptime)
+    fleet.seen(status.board_id, status.firmware, status.version, next_poll)
+
+# What a registered board is told in answer to its status - always when to send the next one
+def status_answer(status: Status, order: None | UpdateOrder) -> dict:
+    # TESTING
+    if registry.is_test(status.board_id):
+        print("Test ID detected. Remember to deal with test ID's before production deployment")
+    if status.board_id == "-2":
+        print("Test update order sent")
+        return { "update": True, "secret": "test_secret", "next_poll": polling.next_poll(ordered=True) }
+
+    # Check for update order
+    if order:
+        print(f"Update order detected for board '{status.board_id}'")
+        return { "update": True, "secret": order.secret, "next_poll": polling.next_poll(ordered=True) }
+
+    return { "next_poll": polling.next_poll() }
+
+def encode(answer: dict, as_cbor=False) -> bytes:
+    return cbor.dumps(answer) if as_cbor else json.dumps(answer, separators=(',', ':')).encode()
+
+# Most answers only say when to ping next - each of those is encoded once (per encoding),
+# and the bytes reused
+idle_answers: dict[tuple[int, bool], bytes] = {}
+
+def encode_answer(answer: dict, as_cbor=False) -> bytes:
+    if len(answer) != 1:
+        return encode(answer, as_cbor)
+    key = (answer["next_poll"], as_cbor)
+    encoded = idle_answers.get(key)
+    if encoded is None:
+        encoded = idle_answers[key] = encode(answer, as_cbor)
+    return encoded
+
+statuses = TypeAdapter(list[Status])
+batch_limit = int(os.environ.get("STATUS_BATCH_LIMIT", 5000))
+batch_max_body = 4 * 1024 * 1024 # checked before anything is parsed
+
+# Statuses relayed by a gateway for many boards at once: a JSON array, or NDJSON (one status
+# per line). They are validated in one pass and their orders looked up together. The answer
+# maps each board id to what the board would have been told on its own - unknown boards get
+# an error there instead of failing the whole batch. Oversized batches are turned away
+# before validation - NDJSON by its lines, JSON arrays by the body size.
+def batch_status(body: bytes, ndjson=False) -> dict:
+    if len(body) > batch_max_body:
+        raise Respond("Request too large", 413)
+    if ndjson:
+        lines = [line for line in body.splitlines() if line.strip()]
+        check_batch_size(len(lines))
+        body = b"[" + b",".join(lines) + b"]"
+    try:
+        batch = statuses.validate_json(body)
+    except ValidationError as e:
+        print("Status batch is invalid")
+        raise Respond(f"JSON format is invalid: {e}", 400)
+    check_batch_size(len(batch))
+
+    polling.rate.add(len(batch))
+    known = [status.board_id for status in batch if status.board_id in registry]
+    orders = state["orders"].get_many(known)
+    answers = {}
+    for status in batch:
+        if status.board_id in registry:
+            answers[status.board_id] = status_answer(status, orders.get(status.board_id))
+            record_status(status, answers[status.board_id]["next_poll"])
+        else:
+            answers[status.board_id] = { "error": f"Unknown ID: {status.board_id}" }
+    print(f"Status batch of {len(batch)} boards ({len(batch) - len(known)} unknown)")
+    return answers
+
+def check_batch_size(size):
+    if size > batch_limit:
+        print(f"Status batch of {size} is too large")
+        raise Respond(f"Too many statuses in one batch (at most {batch_limit})", 413)
+
+def board_request(id, data, request_type) -> tuple[BoardUpdateRequest, None | UpdateOrder]:
+    try:
+        dl_req = validate_board_data(BoardUpdateRequest, data)
+    except ValidationError as e:
+        print(f"Badly formatted {request_type} request. {str(e)}")
+        raise Respond(f"Bad {request_type} request structure", 400)
 
-    testing = dl_req.board_id in state["known_test_ids"]
+    testing = registry.is_test(dl_req.board_id)
+    return dl_req, dl_req.check_request_get_order(id, testing, request_type)
 
-    try:
-        order = dl_req.check_request_get_order(id, testing, "download")
-    except Respond as r:
-        return r()
+# Checks a download request, returning it with the order it is for
+def check_download(id, data) -> tuple[BoardUpdateRequest, UpdateOrder]:
+    dl_req, order = board_request(id, data, "download")
 
-    if testing:
-        return {}
+    if registry.is_test(dl_req.board_id):
+        raise Respond({}, 200)
 
     # check if the board already has that version installed
     if dl_req.firmware == order.firmware and dl_req.version == order.version:
         print(f"This version ('{state["firmware_directory"]}') is already installed on the board")
-        return f"This version is already installed!", 304
+        raise Respond(f"This version is already installed!", 304)
 
+    return dl_req, order
+
+# The bundle to send for an order - built first if only part of it was asked for
+def select_bundle(dl_req: BoardUpdateRequest, order: UpdateOrder, partial=False) -> bundle.BundleInfo:
     # load firmware (known to exist, checked in update ordering process)
-    firmware_dir = os.path.join(state["firmware_directory"], f"{order.firmware}-{order.version}")
-    files = os.listdir(firmware_dir)
-
-    shasums = {}
-
-    # construct tar archive and calculate shasums
-    tar_bytes = io.BytesIO()
-    with tarfile.open(fileobj=tar_bytes, mode='w') as tar:
-        for file in files:
-            path = os.path.join(firmware_dir, file)
-            if os.path.isfile(path):
-                shasums[file] = calculate_shasum(path)
-                tar.add(path, arcname=file)
-        # include shasums in archive (can't really send separately unless I want to do multipart)
-        manifest = json.dumps(shasums).encode('utf-8')
-        manifest_info = tarfile.TarInfo(name="manifest.json")
-        manifest_info.size = len(manifest)
-        tar.addfile(manifest_info, io.BytesIO(manifest))
-
-    tar_bytes.seek(0)
-
-    # send archive
-    return send_file(tar_bytes, mimetype='application/tar')
+    # boards that support it only get the files that differ from their installed version
+    info = None
+    if dl_req.delta:
+        info = bundle.get_delta(dl_req.firmware, dl_req.version, order.firmware, order.version)
+    if not info:
+        info = bundle.get_bundle(order.firmware, order.version)
 
-def delete_order(id):
-    try:
-        dl_req = BoardUpdateRequest.model_validate(request.json, strict=False)
-    except ValidationError as e:
-        print(f"Badly formatted order delete request. {str(e)}")
-        return "Bad order delete request structure", 400
+    # Partial downloads need the complete archive to seek in
+    if partial and not bundle.is_built(info):
+        bundle.build_bundle(info)
+    return info
 
-    testing = dl_req.board_id in state["known_test_ids"]
+# Installation complete (pre-reboot)
+def complete_request(id, data):
+    dl_req, order = board_request(id, data, "order delete")
 
+    # only this order - not one that replaced it in the meantime
+    order_complete(id, order.generation if order else None)
+
+    # check stuff
+    return "Order deleted"
+
+# How bundles already built on disk are sent - the bytes shouldn't pass through Python:
+#  "wrapper": wsgi.file_wrapper, which servers like gunicorn implement with os.sendfile
+#  "x-sendfile": the X-Sendfile header for an Apache/lighttpd front end
+#  "x-accel-redirect": the X-Accel-Redirect header for nginx, with the bundle directory
+#                      exposed as an internal location at BUNDLE_ACCEL_PREFIX
+sendfile_mode = os.environ.get("BUNDLE_SENDFILE", "wrapper")
+accel_prefix = os.environ.get("BUNDLE_ACCEL_PREFIX", "/internal/bundles")
+if sendfile_mode not in ["wrapper", "x-sendfile", "x-accel-redirect"]:
+    raise Exception(f"Unknown BUNDLE_SENDFILE mode: '{sendfile_mode}'")
+
+# The ETag is the bundle's content hash, so it stays the same across restarts and rebuilds,
+# and boards can resume interrupted downloads with Range + If-Range
+def send_bundle(info: bundle.BundleInfo, encoding=None):
+    path = bundle.variant_path(info, encoding) if encoding else info.path
+    etag = bundle.variant_etag(info, encoding)
+    if sendfile_mode == "wrapper":
+        # also answers Range/If-Range requests
+        response = send_file(path, mimetype='application/tar', etag=etag)
+    else:
+        # the front end answers Range/If-Range requests itself
+        response = Response(mimetype='application/tar')
+        response.set_etag(etag)
+        if sendfile_mode == "x-sendfile":
+            response.headers["X-Sendfile"] = path
+        else:
+            response.headers["X-Accel-Redirect"] = f"{accel_prefix}/{os.path.basename(path)}"
+
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+# Board requests are JSON (the body, left for the models to validate), or CBOR (see cbor.py)
+# from boards that would rather not build JSON on their small heap - None for CBOR that
+# doesn't decode. Like request.json, anything else is answered with 415.
+def board_data() -> None | dict | bytes:
+    if request.mimetype == cbor.mimetype:
+        try:
+            return cbor.loads(request.get_data())
+        except ValueError:
+            return None
+    if not request.is_json:
+        return request.json # raises UnsupportedMediaType
+    return request.get_data()
+
+# A gateway's status batch, read no further than batch_max_body (also without a Content-Length)
+def batch_data() -> bytes:
+    if (request.content_length or 0) > batch_max_body:
+        raise Respond("Request too large", 413)
+    body = request.stream.read(batch_max_body + 1)
+    if len(body) > batch_max_body:
+        raise Respond("Request too large", 413)
+    return body
+
+def wants_cbor(accept: None | str) -> bool:
+    if not accept or cbor.mimetype not in accept: # the usual case, without parsing the header
+        return False
+    return parse_accept_header(accept, MIMEAccept).best_match(["application/json", cbor.mimetype]) == cbor.mimetype
+
+# Answers in CBOR for boards that ask for it (Accept), JSON otherwise
+def board_answer(answer: dict):
+    as_cbor = wants_cbor(request.headers.get("Accept"))
+    return Response(encode_answer(answer, as_cbor), mimetype=cbor.mimetype if as_cbor else "application/json")
+
+def download(id):
     try:
-        dl_req.check_request_get_order(id, testing, "download")
+        dl_req, order = check_download(id, board_data())
     except Respond as r:
         return r()
-    
-    state["cleanup_events"][id].set()
 
-    # check stuff
-    return "Order deleted"
+    # Too many boards downloading at once - tell this one when to come back
+    started = downloads.acquire()
+    if started is None:
+        retry_after = downloads.retry_after()
+        print(f"Download from '{id}' turned away, retry after {retry_after} s")
+        return "Too many downloads in progress", 503, {"Retry-After": str(retry_after)}
+
+    # The slot is only freed once the whole response has been sent - exactly once, whichever
+    # of the ways below gets there first
+    once = Lock()
+    def release():
+        if once.acquire(blocking=False):
+            downloads.release(started)
+    release_with_file_wrapper(release)
+    try:
+        response = bundle_response(dl_req, order)
+    except:
+        release()
+        raise
+    response.call_on_close(release)
+    return response
+
+# send_file's responses go to the server as they are (direct_passthrough), so the server
+# closes the file wrapper, and Response.close (with its call_on_close callbacks) never
+# runs. The request's file wrapper is swapped for a subclass of the server's that also
+# calls on_close - a subclass, so gunicorn still recognises it and uses sendfile.
+# It is its own iterator: a Range answer wraps it in werkzeug's _RangeWrapper, which
+# only closes what iter() gave it (gunicorn's wrapper iterates by __getitem__).
+def release_with_file_wrapper(on_close):
+    server_wrapper = request.environ.get("wsgi.file_wrapper", FileWrapper)
+    class ClosingFileWrapper(server_wrapper):
+        def __init__(self, filelike, block_size=8192):
+            super().__init__(filelike, block_size)
+            self.blocks = iter(lambda: filelike.read(block_size), b'')
+            close = getattr(self, "close", None) # gunicorn sets its own close per instance
+            def close_and_release():
+                try:
+                    if close:
+                        close()
+                finally:
+                    on_close()
+            self.close = close_and_release
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return next(self.blocks)
+    request.environ["wsgi.file_wrapper"] = ClosingFileWrapper
+
+def bundle_response(dl_req: BoardUpdateRequest, order: UpdateOrder):
+    info = select_bundle(dl_req, order, "Range" in request.headers)
+
+    # send archive - from disk if it was already built, otherwise generated on the fly
+    if bundle.is_built(info):
+        return send_bundle(info, bundle.negotiate_encoding(info, request.accept_encodings))
+    response = Response(bundle.stream_bundle(info), mimetype='application/tar',
+                        headers={"Content-Length": str(info.size), "Accept-Ranges": "bytes"})
+    response.set_etag(info.digest)
+    response.vary.add("Accept-Encoding")
+    return response
+
+def delete_order(id):
+    try:
+        return complete_request(id, board_data())
+    except Respond as r:
+        return r()
@@ -3,6 +3,7 @@ import os
 from flask import request
 from pydantic import BaseModel
 
+import manifests
 import util
 from util import state
 
@@ -68,9 +69,13 @@ def handle_upload():
                 "please submit a DELETE request, or a new version!", 409
                 # NOTE the DELETE is not implemented, but would be easy - signed request
 
-    # TODO figure out why this doesn't work - probably because it's been decoded already?
+    # Hash while saving, so downloads never have to re-hash the files
+    files = {}
     for name, file in firmware_files.items():
-        file.save(os.path.join(firmware_save_dir, name))
+        files[name] = manifests.save_and_hash(file.stream, os.path.join(firmware_save_dir, name))
+    manifests.write_manifest(manifests.FirmwareManifest(firmware=upload_info.firmware,
+                                                        version=upload_info.version, files=files,
+                                                        fingerprint=manifests.directory_fingerprint(firmware_save_dir)))
 
     print(os.listdir(firmware_save_dir))
 
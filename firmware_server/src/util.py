@@ -1,4 +1,8 @@
+import hashlib
 import os
+import time
+from collections import OrderedDict
+from threading import Lock
 from typing import Optional
 
 from flask import request
@@ -7,11 +11,18 @@ from werkzeug.datastructures import FileStorage, MultiDict
 import pgpy
 from pgpy import PGPSignature
 
+from orders import OrderStore
+from storage import open_storage
+
+# Defined in the Dockerfile - SQLite database for orders, boards and rollouts
+storage = open_storage(os.environ.get("STATE_DATABASE", ""))
+
 # Global state directory with shared data - defined like this so pydantic doesn't get pissed
 state = {
-    "orders": {},
-    "cleanup_events": {},
+    "storage": storage,
+    "orders": OrderStore(storage),
     "firmware_directory": "",
+    "bundle_directory": "",
 }
 
 # Sorts files in the request into the signature, and everything else
@@ -41,8 +52,41 @@ def sort_files(expected_extensions=[]) -> tuple[None | PGPSignature, dict[str, F
                         f"was sent!\n Expected extensions: {expected_extensions}")
     return (signature, other_files)
 
+# Verification results (signer name, or None for no trusted signer), most recently used
+# last - a client retrying an order, or re-ordering with PUT, sends the same signature
+# over the same text, and doesn't need the public key operations again. Keyed by digests
+# of both and the keyring's generation, so a changed keyring never sees an older result.
+# Kept per worker process.
+verification_cache_size = int(os.environ.get("SIGNATURE_CACHE_ENTRIES", 256))
+verification_cache_seconds = float(os.environ.get("SIGNATURE_CACHE_SECONDS", 600))
+verification_cache: OrderedDict[tuple[str, str, str], tuple[float, None | str]] = OrderedDict()
+verification_lock = Lock()
+verification_counts = { "hits": 0, "misses": 0 }
+
+# Changes whenever a signer is added, removed, or gets another key
+def keyring_generation() -> str:
+    sha = hashlib.sha256()
+    for signer_name, key in state["trusted_firmware_signers"].items():
+        sha.update(f"{signer_name}:{key.fingerprint};".encode('utf-8'))
+    return sha.hexdigest()
+
 # Finds the signer of a signature based on text, from the keyring
 def find_signer(signature, text) -> None | str:
+    cache_key = (hashlib.sha256(bytes(signature)).hexdigest(),
+                 hashlib.sha256(text.encode('utf-8')).hexdigest(),
+                 keyring_generation())
+    now = time.monotonic()
+    with verification_lock:
+        cached = verification_cache.get(cache_key)
+        if cached and cached[0] > now:
+            verification_cache.move_to_end(cache_key)
+            verification_counts["hits"] += 1
+            signer = cached[1]
+            if signer:
+                print(f"Signature by: {signer} (verified before)")
+            return signer
+        verification_counts["misses"] += 1
+
     signer = None
     for signer_name, key in state["trusted_firmware_signers"].items():
         verification = key.verify(text, signature)
@@ -50,8 +94,19 @@ def find_signer(signature, text) -> None | str:
             print(f"Signature by: {signer_name}")
             signer = signer_name
             break
+
+    with verification_lock:
+        verification_cache[cache_key] = (now + verification_cache_seconds, signer)
+        verification_cache.move_to_end(cache_key)
+        while len(verification_cache) > verification_cache_size:
+            verification_cache.popitem(last=False)
     return signer
 
+# How often signatures were found in the cache - client API
+def verification_stats() -> dict:
+    with verification_lock:
+        return { **verification_counts, "entries": len(verification_cache), "size": verification_cache_size }
+
 
 class FirmwareInfoRequest(BaseModel):
     firmware: Optional[str] = None
@@ -69,7 +124,8 @@ class FirmwareInfoRequest(BaseModel):
 def available_firmware(req: FirmwareInfoRequest) -> MultiDict:
     # Get all firmware
     firmware: MultiDict = MultiDict()
-    firmware_paths = list(map(lambda fw: fw.split('-'), os.listdir(state["firmware_directory"])))
+    firmware_paths = [entry.name.split('-') for entry in os.scandir(state["firmware_directory"])
+                      if entry.is_dir()] # skip the upload manifests
     # Remove the keys directory
     firmware_paths = filter(lambda pth: pth != ['keys'], firmware_paths)
     for fw_name, version in firmware_paths:
@@ -2,15 +2,28 @@ import requests
 import pgpy
 import os
 import copy
+import hashlib
+import hmac
+import io
+import json
+import socket
+import struct
+import sys
+import tarfile
+import time
 
 # Testing done with requests for black box testing of APIs running in Docker
 # Validation errors are not tested for - Pydantic is responsible server-side
 
 base_url = "http://localhost:8000/firmware"
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import cbor
+
 class EndpointTest:
+    # volatile_keys: keys the response must have, but whose values change (like next_poll)
     def __init__(self, name, endpoint, method, is_json, data,
-                 expected_status, expected_response=None, files=None):
+                 expected_status, expected_response=None, files=None, volatile_keys=[]):
         self.name = name
         self.endpoint = endpoint
         self.method = method
@@ -19,6 +32,7 @@ class EndpointTest:
         self.expected_status = expected_status
         self.expected_response = expected_response
         self.files = files
+        self.volatile_keys = volatile_keys
 
     def test(self):
         url = f"{base_url}{self.endpoint}"
@@ -29,7 +43,11 @@ class EndpointTest:
                 response = requests.request(self.method, url, data=self.data, files=self.files)
             assert response.status_code == self.expected_status, "Bad status"
             if self.expected_response is not None:
-                assert response.json() == self.expected_response, "Bad response"
+                response_json = response.json()
+                for key in self.volatile_keys:
+                    assert key in response_json, f"No '{key}' in response"
+                    del response_json[key]
+                assert response_json == self.expected_response, "Bad response"
             result = "passed"
             error = None
         except AssertionError as e:
@@ -54,7 +72,8 @@ good_status = EndpointTest(
         "uptime": 100,
     },
     200,
-    {}
+    {},
+    volatile_keys=["next_poll"]
 )
 
 # Example good status request with update
@@ -70,7 +89,8 @@ good_status_update = EndpointTest(
         "uptime": 100,
     },
     200,
-    {"update": True, "secret": "test_secret"}
+    {"update": True, "secret": "test_secret"},
+    volatile_keys=["next_poll"]
 )
 
 # Example bad request
@@ -377,6 +397,478 @@ bad_update_success_no_order = copy.deepcopy(good_update_success)
 bad_update_success_no_order.name = "Bad update confirm. - already confirmed"
 bad_update_success_no_order.expected_status = 406
 
+
+# Statuses relayed by a gateway - test IDs answer like single pings, unknown IDs get an error
+good_status_batch = EndpointTest(
+    "Good status batch",
+    "/status/batch",
+    "POST",
+    True,
+    [
+        {"firmware": "blinker", "version": "0.1.0", "board_id": "-1", "uptime": 100},
+        {"firmware": "blinker", "version": "0.1.0", "board_id": "0", "uptime": 100},
+    ],
+    200,
+    None, # {"-1": {"next_poll": ...}, "0": {"error": "Unknown ID: 0"}}
+)
+
+# Bad status batch - more statuses than STATUS_BATCH_LIMIT (set the same here as on the server)
+bad_status_batch_too_large = EndpointTest(
+    "Bad status batch - too many",
+    "/status/batch",
+    "POST",
+    True,
+    [{"firmware": "blinker", "version": "0.1.0", "board_id": "-1", "uptime": 100}]
+        * (int(os.environ.get("STATUS_BATCH_LIMIT", 5000)) + 1),
+    413,
+    # Too many statuses in one batch
+)
+
+
+# Boards already registered are updated - re-registering "example" (KNOWN_IDS) as it is
+boards_json = '[{"board_id": "example"}]'
+
+# Good board import
+good_board_import = EndpointTest(
+    "Good board import",
+    "/boards",
+    "PUT",
+    False,
+    None,
+    200,
+    None, # {"imported": 1, "boards": ...}
+    {
+        'boards.json': boards_json,
+        'sig.asc': str(priv_key.sign(boards_json))
+    }
+)
+
+# Bad board import - invalid signature
+bad_board_import_sign = EndpointTest(
+    "Bad board import signature",
+    "/boards",
+    "PUT",
+    False,
+    None,
+    401,
+    None, # Invalid or unknown signature
+    {
+        'boards.json': boards_json,
+        'sig.asc': str(priv_key.sign(boards_json + "lol"))
+    }
+)
+
+# Bad board import - rows that aren't boards
+not_boards_json = '[1, "x"]'
+bad_board_import_rows = EndpointTest(
+    "Bad board import - not boards",
+    "/boards",
+    "PUT",
+    False,
+    None,
+    400,
+    None, # Bad board list: Expected a list of boards
+    {
+        'boards.json': not_boards_json,
+        'sig.asc': str(priv_key.sign(not_boards_json))
+    }
+)
+
+
+# Good fleet counts
+good_fleet = EndpointTest(
+    "Good fleet counts",
+    "/fleet",
+    "GET",
+    False,
+    None,
+    200,
+    None, # {"boards": ..., "versions": {...}, "liveness": {...}}
+)
+
+# Bad offline board list - limit isn't a number
+bad_fleet_offline_limit = EndpointTest(
+    "Bad fleet offline - bad limit",
+    "/fleet/offline?limit=lots",
+    "GET",
+    False,
+    None,
+    400,
+    # 'limit' must be a number
+)
+
+# Bad fleet offline - a limit below 1 (which SQLite would take as no limit at all)
+bad_fleet_offline_negative = EndpointTest(
+    "Bad fleet offline - negative limit",
+    "/fleet/offline?limit=-1",
+    "GET",
+    False,
+    None,
+    400,
+    # 'limit' must be a number of at least 1
+)
+
+
+# Good last seen - the test ID pinged above
+good_history_last_seen = EndpointTest(
+    "Good history - last seen",
+    "/history/-1/last-seen",
+    "GET",
+    False,
+    None,
+    200,
+    None, # {"board_id": "-1", "last_seen": ..., ...}
+)
+
+# Bad last seen - unknown ID
+bad_history_unknown_id = EndpointTest(
+    "Bad history - unknown ID",
+    "/history/0/last-seen",
+    "GET",
+    False,
+    None,
+    404,
+    # Unknown board ID
+)
+
+# Bad version history - more than 1000 buckets
+bad_history_versions_bucket = EndpointTest(
+    "Bad history - too many buckets",
+    "/history/versions?hours=24&bucket=60",
+    "GET",
+    False,
+    None,
+    400,
+    # 'bucket' must be at least ... seconds, and at most 1000 buckets long
+)
+
+# For scenarios that need a server set up differently than the one in Docker
+class Skipped(Exception):
+    pass
+
+# Tests that take more than one request: the scenario asserts on what it gets back, and is
+# reported like an EndpointTest
+class ScenarioTest:
+    def __init__(self, name, scenario):
+        self.name = name
+        self.scenario = scenario
+
+    def test(self):
+        try:
+            self.scenario()
+            result = "passed"
+            error = None
+        except Skipped as e:
+            result = "skipped"
+            error = str(e)
+        except AssertionError as e:
+            result = "failed - assert"
+            error = str(e)
+        except Exception as e:
+            result = "failed - error"
+            error = str(e)
+
+        return f"{self.name:<35} ... {result:<15}" + ("" if not error else f" - {error}")
+
+# Downloads need a registered board that isn't a test ID, and firmware that is really
+# stored (test IDs and "test" firmware never get a bundle)
+download_board = "example" # KNOWN_IDS
+
+# Uploads firmware signed like upload_frimware.sh does - already uploaded (409) is fine
+def upload_firmware(firmware_directory) -> tuple[str, str]:
+    firmware, version = os.path.basename(firmware_directory).rsplit('-', 1)
+    names = sorted(name for name in os.listdir(firmware_directory) if name.endswith(".py"))
+    texts = {}
+    for name in names:
+        with open(os.path.join(firmware_directory, name), 'r') as f:
+            texts[name] = f.read()
+    upload_sig = str(priv_key.sign("".join(texts[name] for name in names)))
+    response = requests.put(f"{base_url}/upload", data={"firmware": firmware, "version": version},
+                            files=[("file", (name, texts[name])) for name in names] + [("sig.asc", upload_sig)])
+    assert response.status_code in [200, 409], f"Upload failed: {response.status_code}"
+    return firmware, version
+
+# Orders firmware for a board, and returns the download request the board then sends
+# (with the version it has installed)
+def order_download(board_id, firmware, version, installed="0.0.0") -> dict:
+    order_sig = str(priv_key.sign(f"{firmware}-{version}-{board_id}"))
+    response = requests.put(f"{base_url}/update/{board_id}", data={"firmware": firmware, "version": version},
+                            files={"sig.asc": order_sig})
+    assert response.status_code == 200, f"Order failed: {response.status_code}"
+    status = {"firmware": firmware, "version": installed, "board_id": board_id, "uptime": 100}
+    secret = requests.post(f"{base_url}/status", json=status).json()["secret"]
+    return {"firmware": firmware, "version": installed, "board_id": board_id, "secret": secret}
+
+# Uncompressed, unless the headers ask otherwise
+def download(download_request, headers={}):
+    return requests.get(f"{base_url}/update/{download_request['board_id']}", json=download_request,
+                        headers={"Accept-Encoding": "identity", **headers})
+
+def cancel_order(download_request):
+    requests.delete(f"{base_url}/update/{download_request['board_id']}", json=download_request)
+
+# Resumed downloads: a Range is answered with just those bytes, a Range past the end with a
+# 416, and an If-Range with an ETag that isn't the bundle's any more with the whole bundle
+def ranged_downloads():
+    firmware, version = upload_firmware("../firmware/blinker-0.1.1")
+    download_request = order_download(download_board, firmware, version)
+    try:
+        full = download(download_request)
+        assert full.status_code == 200, f"Bad status: {full.status_code}"
+        size, etag = len(full.content), full.headers["ETag"]
+
+        part = download(download_request, {"Range": "bytes=0-99"})
+        assert part.status_code == 206, f"Bad range status: {part.status_code}"
+        assert part.content == full.content[:100], "Bad range"
+        assert part.headers.get("Content-Range") == f"bytes 0-99/{size}", "Bad Content-Range"
+
+        resumed = download(download_request, {"Range": "bytes=100-", "If-Range": etag})
+        assert resumed.status_code == 206 and resumed.content == full.content[100:], "Bad resumed range"
+
+        past_end = download(download_request, {"Range": f"bytes={size}-"})
+        assert past_end.status_code == 416, f"Bad status past the end: {past_end.status_code}"
+
+        stale = download(download_request, {"Range": "bytes=100-", "If-Range": '"stale"'})
+        assert stale.status_code == 200 and stale.content == full.content, "Stale If-Range wasn't answered in full"
+    finally:
+        cancel_order(download_request)
+
+good_ranged_downloads = ScenarioTest("Good downloads - ranges", ranged_downloads)
+
+def bundle_files(response) -> dict[str, bytes]:
+    with tarfile.open(fileobj=io.BytesIO(response.content)) as archive:
+        return {member.name: archive.extractfile(member).read() for member in archive.getmembers()}
+
+# A board that has 0.1.0 installed and can apply deltas only gets the files 0.1.1 changed
+# (at least config.py, with the version in it) - fewer than the whole bundle has
+def delta_download():
+    upload_firmware("../firmware/blinker-0.1.0")
+    firmware, version = upload_firmware("../firmware/blinker-0.1.1")
+    download_request = order_download(download_board, firmware, version, installed="0.1.0")
+    try:
+        whole = bundle_files(download(download_request))
+        response = download({**download_request, "delta": True})
+        assert response.status_code == 200, f"Bad status: {response.status_code}"
+        delta = bundle_files(response)
+        assert "delta.json" not in whole, "Whole bundle has a delta.json"
+        assert json.loads(delta.pop("delta.json"))["base"] == "blinker-0.1.0", "Bad delta base"
+        manifest = json.loads(delta.pop("manifest.json"))
+        assert sorted(manifest) == sorted(delta), "Manifest doesn't list the delta's files"
+        assert "config.py" in delta and len(delta) < len(whole) - 1, f"Bad delta files: {sorted(delta)}"
+        assert all(whole[name] == contents for name, contents in delta.items()), "Delta files differ from the bundle"
+    finally:
+        cancel_order(download_request)
+
+good_delta_download = ScenarioTest("Good download - delta", delta_download)
+
+# Boards that accept deflate get the precompressed variant of a built bundle, with an ETag
+# of its own - a 304 when they already have it
+def compressed_download():
+    firmware, version = upload_firmware("../firmware/blinker-0.1.1")
+    download_request = order_download(download_board, firmware, version)
+    try:
+        identity = download(download_request) # builds the bundle, and then its variants
+        etag = identity.headers["ETag"][:-1] + '-deflate"'
+        for _ in range(10):
+            response = download(download_request, {"Accept-Encoding": "deflate"})
+            if response.headers.get("Content-Encoding") == "deflate":
+                break
+            time.sleep(0.2) # still compressing
+        assert response.headers.get("Content-Encoding") == "deflate", "No deflate variant"
+        assert response.headers.get("ETag") == etag, f"Bad ETag: {response.headers.get('ETag')}"
+        assert response.content == identity.content, "Inflated variant differs from the bundle"
+
+        cached = download(download_request, {"Accept-Encoding": "deflate", "If-None-Match": etag})
+        assert cached.status_code == 304, f"Bad status with a matching ETag: {cached.status_code}"
+    finally:
+        cancel_order(download_request)
+
+good_compressed_download = ScenarioTest("Good download - deflate", compressed_download)
+
+# Downloads in progress and waiting in the worker that answers
+good_download_admission = EndpointTest(
+    "Good download admission",
+    "/downloads",
+    "GET",
+    False,
+    None,
+    200,
+    {},
+    volatile_keys=["active", "waiting", "limit", "queue"]
+)
+
+# More downloads in a row than the server admits at once (DOWNLOAD_CONCURRENCY - or half
+# of WEB_THREADS - set the same here as on the server), whole and resumed (Range) - each one
+# has to give its slot back when it is done, or the last ones are turned away with a 503
+sequential_downloads_count = int(os.environ.get("DOWNLOAD_CONCURRENCY") or int(os.environ.get("WEB_THREADS", 8)) // 2) + 1
+
+def sequential_downloads():
+    firmware, version = upload_firmware("../firmware/blinker-0.1.1")
+    download_request = order_download(download_board, firmware, version)
+    try:
+        # the first download builds the bundle - the rest are sent from disk
+        download(download_request)
+        codes = [download(download_request).status_code for _ in range(sequential_downloads_count)]
+        codes += [download(download_request, {"Range": "bytes=100-"}).status_code
+                  for _ in range(sequential_downloads_count)]
+        assert codes == [200] * sequential_downloads_count + [206] * sequential_downloads_count, f"Bad status: {codes}"
+    finally:
+        cancel_order(download_request)
+
+good_sequential_downloads = ScenarioTest("Good downloads - more than the limit", sequential_downloads)
+
+# Rollouts need firmware that is really stored (blinker-0.1.1, uploaded by the sequential
+# downloads test) - to "example", which then has an order until it expires
+rollout_json = '{"firmware": "blinker", "version": "0.1.1", "boards": ["example"]}'
+
+# Good rollout
+good_rollout = EndpointTest(
+    "Good rollout",
+    "/rollout",
+    "POST",
+    False,
+    None,
+    200,
+    None, # the rollout's progress
+    {
+        'rollout.json': rollout_json,
+        'sig.asc': str(priv_key.sign(rollout_json))
+    }
+)
+
+# Bad rollout - invalid signature
+bad_rollout_sign = EndpointTest(
+    "Bad rollout signature",
+    "/rollout",
+    "POST",
+    False,
+    None,
+    401,
+    None, # Invalid or unknown signature
+    {
+        'rollout.json': rollout_json,
+        'sig.asc': str(priv_key.sign(rollout_json + "lol"))
+    }
+)
+
+# Bad rollout progress - unknown rollout
+bad_rollout_status = EndpointTest(
+    "Bad rollout progress - unknown ID",
+    "/rollout/0000000000000000",
+    "GET",
+    False,
+    None,
+    404,
+    # Unknown rollout
+)
+
+# The push channel is only served by the ASGI app: set ASGI_URL to its /firmware URL
+# (sharing the STATE_DATABASE with the Flask app at base_url) to test it
+asgi_url = os.environ.get("ASGI_URL")
+
+# A board listening on its push channel hears about an order the moment it is placed
+def push_order():
+    if not asgi_url:
+        raise Skipped("no ASGI_URL")
+    firmware, version = upload_firmware("../firmware/blinker-0.1.1")
+    cancel_order(order_download(download_board, firmware, version)) # no order to start with
+    time.sleep(1) # for the other processes to hear about that (EVENT_POLL_INTERVAL)
+    with requests.get(f"{asgi_url}/push/{download_board}", stream=True, timeout=10) as channel:
+        assert channel.status_code == 200, f"Bad status: {channel.status_code}"
+        lines = channel.iter_lines(decode_unicode=True)
+        assert next(lines) == ": connected", "Channel didn't start empty"
+        download_request = order_download(download_board, firmware, version)
+        try:
+            line = next(lines)
+            while line != "event: update":
+                line = next(lines)
+            pushed = json.loads(next(lines).removeprefix("data: "))
+            assert pushed == {"update": True, "secret": download_request["secret"]}, f"Bad push: {pushed}"
+        finally:
+            cancel_order(download_request)
+
+good_push_order = ScenarioTest("Good push channel - order", push_order)
+
+def push_unknown_id():
+    if not asgi_url:
+        raise Skipped("no ASGI_URL")
+    response = requests.get(f"{asgi_url}/push/0", timeout=10) # Reserved for testing, unknown ID
+    assert response.status_code == 401, f"Bad status: {response.status_code}"
+
+bad_push_unknown_id = ScenarioTest("Bad push channel - unknown ID", push_unknown_id)
+
+# Heartbeats need the server's HEARTBEAT_KEY (and HEARTBEAT_PORT, if it isn't the default)
+heartbeat_key = os.environ.get("HEARTBEAT_KEY")
+heartbeat_port = int(os.environ.get("HEARTBEAT_PORT") or 8001)
+
+def heartbeat_tag(key, message) -> bytes:
+    return hmac.new(key, message, hashlib.sha256).digest()[:8]
+
+# A heartbeat with a good tag is answered (tagged, with its counter), one with a bad tag
+# isn't, and neither is the same heartbeat sent again
+def heartbeats():
+    if not heartbeat_key:
+        raise Skipped("no HEARTBEAT_KEY")
+    board_key = hmac.new(heartbeat_key.encode(), download_board.encode(), hashlib.sha256).digest()
+    firmware_id = int.from_bytes(hashlib.sha256(b"blinker-0.1.1").digest()[:4], "big")
+    counter = int(time.time()) << 32 | 1 # a new "boot" every run, so it is past the stored counter
+    body = struct.pack("!4sB16sIIQ", b"FWHB", 1, download_board.encode(), firmware_id, 100, counter)
+    address = (base_url.split('/')[2].split(':')[0], heartbeat_port)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(1)
+        def answer(packet) -> None | bytes:
+            sock.sendto(packet, address)
+            try:
+                return sock.recv(64)
+            except socket.timeout:
+                return None
+
+        assert answer(body + bytes(8)) is None, "Heartbeat with a bad tag was answered"
+        reply = answer(body + heartbeat_tag(board_key, body))
+        assert reply is not None, "Heartbeat wasn't answered"
+        assert reply[15:] == heartbeat_tag(board_key, reply[:15]), "Bad answer tag"
+        magic, _, _, answered = struct.unpack("!4sBHQ", reply[:15])
+        assert magic == b"FWHA" and answered == counter, "Bad answer"
+        assert answer(body + heartbeat_tag(board_key, body)) is None, "Replayed heartbeat was answered"
+
+good_heartbeats = ScenarioTest("Good heartbeat - tags and replays", heartbeats)
+
+# Boards can send their status in CBOR and ask for the answer in it - one that doesn't
+# decode is a bad request
+def cbor_status():
+    status = {"firmware": "blinker", "version": "0.1.0", "board_id": "-2", "uptime": 100} # update=true
+    headers = {"Content-Type": cbor.mimetype, "Accept": cbor.mimetype}
+    response = requests.post(f"{base_url}/status", data=cbor.dumps(status), headers=headers)
+    assert response.status_code == 200, f"Bad status: {response.status_code}"
+    assert response.headers.get("Content-Type") == cbor.mimetype, "Answer isn't CBOR"
+    answer = cbor.loads(response.content)
+    assert "next_poll" in answer, "No 'next_poll' in answer"
+    del answer["next_poll"]
+    assert answer == {"update": True, "secret": "test_secret"}, f"Bad answer: {answer}"
+
+    response = requests.post(f"{base_url}/status", data=b"\xff\x00", headers=headers)
+    assert response.status_code == 400, f"Bad status for broken CBOR: {response.status_code}"
+
+good_cbor_status = ScenarioTest("Good status ping - CBOR", cbor_status)
+
+# An order sent again with the same signature is verified from the cache - counted per worker,
+# so over one connection (keep-alive keeps it on the same worker)
+def signature_cache():
+    with requests.Session() as session:
+        before = session.get(f"{base_url}/signatures").json()
+        order_sig = gen_order_sig()
+        for _ in range(2):
+            response = session.put(f"{base_url}/update/{order_dict['board_id']}",
+                                   data={"firmware": "test", "version": "1.0.0"}, files={"sig.asc": order_sig})
+            assert response.status_code == 200, f"Order failed: {response.status_code}"
+        after = session.get(f"{base_url}/signatures").json()
+        session.delete(f"{base_url}/update/{order_dict['board_id']}", json={**order_dict, "secret": "test_secret"})
+    assert after["misses"] == before["misses"] + 1, f"Misses went from {before['misses']} to {after['misses']}"
+    assert after["hits"] == before["hits"] + 1, f"Hits went from {before['hits']} to {after['hits']}"
+
+good_signature_cache = ScenarioTest("Good signatures - cache hit", signature_cache)
+
 tests = [
     good_status,
     good_status_update,
@@ -397,6 +889,30 @@ tests = [
     bad_update_request_secret,
     good_update_success, # same logic as update request, so not testing for id and secret
     bad_update_success_no_order, 
+    good_status_batch,
+    bad_status_batch_too_large,
+    good_board_import,
+    bad_board_import_sign,
+    bad_board_import_rows,
+    good_fleet,
+    bad_fleet_offline_limit,
+    bad_fleet_offline_negative,
+    good_history_last_seen,
+    bad_history_unknown_id,
+    bad_history_versions_bucket,
+    good_ranged_downloads,
+    good_delta_download,
+    good_compressed_download,
+    good_sequential_downloads,
+    good_download_admission,
+    good_rollout,
+    bad_rollout_sign,
+    bad_rollout_status,
+    good_push_order,
+    bad_push_unknown_id,
+    good_heartbeats,
+    good_cbor_status,
+    good_signature_cache,
 ]
 
 for test in tests: